@@ -1,24 +1,274 @@
-import EasyPySpin
 import cv2
 import numpy as np
+import functools
+from scipy.ndimage import maximum_filter
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 
+from camera import open_camera
+
+camera = None  # camera session shared by every imcapture call, see camera.py
+
 
 def imcapture(filepath, gain=-1):
-    cap = EasyPySpin.VideoCapture(0)
+    # take a picture and save it to filepath, also returned as a numpy array
+    # new code should use camera.Camera.grab directly instead of the PNG round trip
+    global camera
+    if camera is None:
+        camera = open_camera()
+    camera.set_gain(gain)
+    frame = camera.grab()
+    cv2.imwrite(filepath, frame)
+    return frame
 
-    if not cap.isOpened():
-        print("Camera can't open\nexit")
-        return -1
+FIT_MAX_ITER = 100  # Levenberg-Marquardt iterations of fit_gaussians
+FIT_TOL = 1e-8  # relative change of the residual sum of squares at convergence
 
-    cap.set(cv2.CAP_PROP_EXPOSURE, -1)  # -1 sets exposure_time to auto
-    cap.set(cv2.CAP_PROP_GAIN, gain)  # -1 sets gain to auto
 
-    ret, frame = cap.read()
-    cv2.imwrite(filepath, frame)
-    cap.release()
-    cv2.destroyAllWindows()
+def gaussian_2d(xy, amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation):
+    x, y = xy
+    x_rot = (x - x_mean) * np.cos(rotation) - (y - y_mean) * np.sin(rotation)
+    y_rot = (x - x_mean) * np.sin(rotation) + (y - y_mean) * np.cos(rotation)
+    exponent = -((x_rot / x_stddev) ** 2 + (y_rot / y_stddev) ** 2) / 2
+    return amplitude * np.exp(exponent)
+
+
+def gaussian_2d_jac(xy, amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation):
+    # analytic derivatives of gaussian_2d w.r.t. its 6 parameters, (..., 6); the parameters may be arrays with a
+    # trailing axis of length 1 to evaluate a stack of Gaussians at once
+    x, y = xy
+    c, s = np.cos(rotation), np.sin(rotation)
+    dx, dy = x - x_mean, y - y_mean
+    x_rot, y_rot = dx * c - dy * s, dx * s + dy * c
+    ux, uy = x_rot / x_stddev ** 2, y_rot / y_stddev ** 2
+    e = np.exp(-(x_rot * ux + y_rot * uy) / 2)
+    g = amplitude * e
+    return np.stack((e, g * (ux * c + uy * s), g * (uy * c - ux * s), g * x_rot * ux / x_stddev,
+                     g * y_rot * uy / y_stddev, g * x_rot * y_rot * (1 / x_stddev ** 2 - 1 / y_stddev ** 2)), axis=-1)
+
+
+@functools.lru_cache(maxsize=8)
+def coordinate_grid(shape):
+    # flattened pixel coordinates of a (rows, cols) ROI, shared by every fit of that size
+    yy, xx = np.indices(shape)
+    return xx.ravel().astype(np.float64), yy.ravel().astype(np.float64)
+
+
+def extract_rois(image, centers, d):
+    # (n, 2 * (d // 2), 2 * (d // 2)) stack of the windows Fitting uses, center = (row, col); out of range pixels are 0
+    h = d // 2
+    centers = np.rint(np.asarray(centers, dtype=np.float64)).astype(int).reshape(-1, 2)
+    padded = np.pad(np.asarray(image, dtype=np.float64), h)
+    offset = np.arange(2 * h)
+    rows = centers[:, 0, None] + offset  # padded index of center - h + offset
+    cols = centers[:, 1, None] + offset
+    return padded[rows[:, :, None], cols[:, None, :]]
+
+
+MOMENT_LEVEL = 0.2  # pixels above this fraction of the peak enter the log-Gaussian estimate
+
+
+def moment_gaussians(rois, level=MOMENT_LEVEL):
+    # Fit-free estimate of (amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation) of every ROI of a (n, rows, cols)
+    # stack, in the parametrisation of gaussian_2d, vectorised over all ROIs.
+    # Linearised log-Gaussian: log(I - background) is a quadratic in (x, y), fitted by weighted linear least squares
+    # (weights I^2) on the pixels above `level` of the peak; background = median of the ROI border. ROIs where the
+    # quadratic is not a peak fall back to the first and second moments.
+    rois = np.asarray(rois, dtype=np.float64)
+    n, shape = rois.shape[0], rois.shape[1:]
+    x, y = coordinate_grid(shape)
+    data = rois.reshape(n, -1)
+    border = np.concatenate((rois[:, 0, :], rois[:, -1, :], rois[:, 1:-1, 0], rois[:, 1:-1, -1]), axis=1)
+    w = np.clip(data - np.median(border, axis=1)[:, None], 0, None)
+
+    # moments of the pixels above the level: centre and covariance
+    sel = w * (w > level * w.max(axis=1, keepdims=True))
+    total = np.maximum(sel.sum(axis=1), 1e-12)
+    x_mean, y_mean = sel @ x / total, sel @ y / total
+    dx, dy = x - x_mean[:, None], y - y_mean[:, None]
+    cov = np.stack((np.stack(((sel * dx * dx).sum(axis=1), (sel * dx * dy).sum(axis=1)), axis=-1),
+                    np.stack(((sel * dx * dy).sum(axis=1), (sel * dy * dy).sum(axis=1)), axis=-1)), axis=1) / total[:, None, None]
+
+    # log-Gaussian: log w = a + b x + c y + d x^2 + e xy + f y^2
+    design = np.column_stack((np.ones_like(x), x, y, x * x, x * y, y * y))
+    weight = sel ** 2
+    lhs = np.einsum('kp,pi,pj->kij', weight, design, design) + 1e-9 * np.eye(6)
+    rhs = np.einsum('kp,kp,pi->ki', weight, np.log(np.maximum(w, 1e-12)), design)
+    coef = np.linalg.solve(lhs, rhs[:, :, None])[:, :, 0]
+    Q = -2 * np.stack((np.stack((coef[:, 3], coef[:, 4] / 2), axis=-1), np.stack((coef[:, 4] / 2, coef[:, 5]), axis=-1)), axis=1)
+    peak = (Q[:, 0, 0] > 0) & (np.linalg.det(Q) > 0)
+    if np.any(peak):
+        cov_q = np.linalg.inv(Q[peak])
+        mu = np.einsum('kij,kj->ki', cov_q, coef[peak, 1:3])
+        cov[peak] = cov_q
+        x_mean[peak], y_mean[peak] = mu[:, 0], mu[:, 1]
+
+    # x_rot = dx cos - dy sin has no cross term with y_rot when tan(2 rotation) = -2 cxy / (cxx - cyy)
+    cxx, cyy, cxy = cov[:, 0, 0], cov[:, 1, 1], cov[:, 0, 1]
+    rotation = np.mod(0.5 * np.arctan2(-2 * cxy, cxx - cyy), 2 * np.pi)
+    c, s = np.cos(rotation), np.sin(rotation)
+    var_x = c * c * cxx - 2 * c * s * cxy + s * s * cyy
+    var_y = s * s * cxx + 2 * c * s * cxy + c * c * cyy
+    x_stddev, y_stddev = np.sqrt(np.maximum(var_x, 1e-6)), np.sqrt(np.maximum(var_y, 1e-6))
+    # amplitude: linear least squares of the image against the unit Gaussian
+    g = gaussian_2d((x, y), 1.0, x_mean[:, None], y_mean[:, None], x_stddev[:, None], y_stddev[:, None], rotation[:, None])
+    amplitude = np.einsum('ij,ij->i', w, g) / np.maximum(np.einsum('ij,ij->i', g, g), 1e-12)
+    return np.column_stack((amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation))
+
+
+def fit_gaussians(rois, p0=None, max_iter=FIT_MAX_ITER, tol=FIT_TOL):
+    # Rotated 2D Gaussian fit of every ROI of a (n, rows, cols) stack at once: batched Levenberg-Marquardt with the
+    # analytic Jacobian on the shared coordinate grid, n 6x6 normal equations per iteration instead of n curve_fit calls.
+    # Returns (popt (n, 6), converged (n,)); traps that did not converge are refitted with curve_fit + jac.
+    rois = np.asarray(rois, dtype=np.float64)
+    n, shape = rois.shape[0], rois.shape[1:]
+    xy = coordinate_grid(shape)
+    data = rois.reshape(n, -1)
+    if p0 is None:
+        p0 = moment_gaussians(rois)  # a few iterations from here instead of from a fixed guess
+    p = np.array(p0, dtype=np.float64).reshape(n, 6)
+
+    def residual(p):
+        return data - gaussian_2d(xy, *(p.T[:, :, None]))
+
+    r = residual(p)
+    cost = np.einsum('ij,ij->i', r, r)
+    lam = np.full(n, 1e-3)
+    active = np.ones(n, dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        J = gaussian_2d_jac(xy, *(p[idx].T[:, :, None]))  # (k, pixels, 6)
+        JTJ = np.einsum('kpi,kpj->kij', J, J)
+        JTr = np.einsum('kpi,kp->ki', J, r[idx])
+        diag = np.einsum('kii->ki', JTJ)
+        A = JTJ + (lam[idx, None] * np.maximum(diag, 1e-12))[:, :, None] * np.eye(6)
+        try:
+            step = np.linalg.solve(A, JTr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            break
+        trial = p[idx] + step
+        trial[:, 3:5] = np.abs(trial[:, 3:5])  # the model only depends on the squared widths
+        r_trial = data[idx] - gaussian_2d(xy, *(trial.T[:, :, None]))
+        cost_trial = np.einsum('ij,ij->i', r_trial, r_trial)
+        better = np.isfinite(cost_trial) & (cost_trial <= cost[idx])
+        good, bad = idx[better], idx[~better]
+        done = better & (cost[idx] - cost_trial <= tol * np.maximum(cost[idx], 1e-300))
+        p[good], r[good], cost[good] = trial[better], r_trial[better], cost_trial[better]
+        lam[good] = np.maximum(lam[good] / 10, 1e-12)
+        lam[bad] *= 10
+        active[idx[done]] = False
+        active[bad[lam[bad] > 1e10]] = False  # no further progress possible, left to the fallback below
+    converged = ~active & (lam < 1e10)
+
+    bounds = (0, [np.inf, np.inf, np.inf, np.inf, np.inf, 2 * np.pi])
+    for i in np.flatnonzero(~converged):
+        try:
+            start = np.clip(p[i], 0, bounds[1])
+            p[i], _ = curve_fit(gaussian_2d, xy, data[i], p0=start, jac=gaussian_2d_jac, bounds=bounds)
+            converged[i] = True
+        except (RuntimeError, ValueError):
+            pass
+    p[:, 5] = np.mod(p[:, 5], 2 * np.pi)
+    return p, converged
+
+
+def fit_traps(image, centers, d, mode='fit'):
+    # I0, sigma_x, sigma_y of every trap, same windows and model as Fitting.start_fit
+    # mode 'fit': batched fit seeded with the moments, 'moments': moment estimate only (no fit)
+    rois = extract_rois(image, centers, d)
+    if mode == 'moments':
+        popt = moment_gaussians(rois)
+    elif mode == 'fit':
+        popt, _ = fit_gaussians(rois)
+    else:
+        raise ValueError(f"mode must be one of these: 'fit' or 'moments', not {mode!r}")
+    return popt[:, 0], popt[:, 3], popt[:, 4]
+
+
+NEIGHBORHOOD_SIZE = 50  # pixels, window of the non-maximum suppression in find_traps
+MIN_SEPARATION = 5  # pixels, closer peaks are merged into the brighter one
+THRESHOLD_SIGMA = 10  # default peak threshold of find_traps: background median + THRESHOLD_SIGMA * noise
+CENTROID_SIZE = 11  # pixels, window of the sub-pixel centroid
+
+
+def to_gray(image):
+    image = np.asarray(image, dtype=np.float64)
+    return image.mean(axis=2) if image.ndim == 3 else image
+
+
+def centroids(image, positions, size=CENTROID_SIZE):
+    # sub-pixel (row, col) of the intensity centroid around every position, background = median of the window border
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    windows = extract_rois(image, positions, size + 1)  # pixels -h .. h - 1 around each position, h = (size + 1) // 2
+    border = np.concatenate((windows[:, 0, :], windows[:, -1, :], windows[:, 1:-1, 0], windows[:, 1:-1, -1]), axis=1)
+    windows = np.clip(windows - np.median(border, axis=1)[:, None, None], 0, None)
+    total = np.maximum(windows.sum(axis=(1, 2)), 1e-12)
+    offset = np.arange(windows.shape[1]) - windows.shape[1] // 2
+    row = (windows.sum(axis=2) @ offset) / total
+    col = (windows.sum(axis=1) @ offset) / total
+    return np.rint(positions) + np.column_stack((row, col))
+
+
+def find_traps(image, ntrap=None, neighborhood_size=NEIGHBORHOOD_SIZE, threshold=None, border=(0, 0),
+               min_separation=MIN_SEPARATION, centroid_size=CENTROID_SIZE):
+    # Trap positions (row, col) with sub-pixel accuracy, in ascending column order (the order of the trap list and its
+    # amplitudes everywhere in IntOpt).
+    # 1. non-maximum suppression: pixels equal to the maximum of their neighborhood and above threshold
+    #    (default: THRESHOLD_SIGMA noise levels above the background median, noise = 1.4826 * MAD, at least one count,
+    #    so that dim traps, the ones the optimisation has to fix, are kept)
+    # 2. border exclusion: (rows, cols) margins
+    # 3. minimum separation: of two peaks closer than min_separation only the brighter one is kept (KD-tree pairs)
+    # 4. ntrap: keep only the ntrap brightest peaks
+    gray = to_gray(image)
+    if threshold is None:
+        background = np.median(gray)
+        noise = max(1.4826 * np.median(np.abs(gray - background)), 1.0)
+        threshold = background + THRESHOLD_SIGMA * noise
+    peak = (gray == maximum_filter(gray, neighborhood_size)) & (gray > threshold)
+    margin_r, margin_c = border
+    peak[:margin_r], peak[gray.shape[0] - margin_r:] = False, False
+    peak[:, :margin_c], peak[:, gray.shape[1] - margin_c:] = False, False
+    positions = np.argwhere(peak)
+    value = gray[peak]
+
+    if len(positions) > 1 and min_separation > 0:
+        pairs = cKDTree(positions).query_pairs(min_separation, output_type='ndarray')
+        # the weaker peak of every close pair is dropped (ties: the later one)
+        weaker = np.where((value[pairs[:, 0]] >= value[pairs[:, 1]]), pairs[:, 1], pairs[:, 0])
+        keep = np.ones(len(positions), dtype=bool)
+        keep[weaker] = False
+        positions, value = positions[keep], value[keep]
+    if ntrap is not None and len(positions) > ntrap:
+        brightest = np.argsort(value)[::-1][:ntrap]
+        positions = positions[brightest]
+
+    positions = centroids(gray, positions, centroid_size)
+    return positions[np.argsort(positions[:, 1], kind='stable')]
+
+
+class TrapLocator:
+    # find_traps once, then reuse the validated positions in every iteration (optionally re-centred on the new image)
+    def __init__(self, ntrap, **kwargs):
+        self.ntrap = ntrap
+        self.kwargs = kwargs  # passed to find_traps
+        self.positions = None
+
+    def locate(self, image, refine=False):
+        if self.positions is None:
+            positions = find_traps(image, self.ntrap, **self.kwargs)
+            if len(positions) != self.ntrap:
+                raise ValueError(f'Number of local maxima ({len(positions)}) does not match the number of traps ({self.ntrap})!!!')
+            self.positions = positions
+        elif refine:
+            self.positions = centroids(to_gray(image), self.positions, self.kwargs.get('centroid_size', CENTROID_SIZE))
+        return self.positions
+
+    def reset(self):
+        self.positions = None
+
 
 class Fitting():
     def __init__(self, image, center, d):
@@ -36,26 +286,21 @@ class Fitting():
         else:
             return False
 
-    def start_fit(self):
+    def start_fit(self, mode='fit'):
         # return the fitted amplitude
-        def gaussian_2d(xy, amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation):
-            x, y = xy
-            x_rot = (x - x_mean) * np.cos(rotation) - (y - y_mean) * np.sin(rotation)
-            y_rot = (x - x_mean) * np.sin(rotation) + (y - y_mean) * np.cos(rotation)
-            exponent = -((x_rot / x_stddev) ** 2 + (y_rot / y_stddev) ** 2) / 2
-            return amplitude * np.exp(exponent)
-
-        x = np.arange(self.image.shape[1])
-        y = np.arange(self.image.shape[0])
-        xx, yy = np.meshgrid(x, y)
-
-        xy = (xx.flatten(), yy.flatten())
-        data = self.image.flatten()
-
-        bounds = (0, [np.inf, np.inf, np.inf, np.inf, np.inf, 2 * np.pi])
-        popt, _ = curve_fit(gaussian_2d, xy, data, p0=[np.max(self.image), self.d//2, self.d//2, 10, 10, 0],
-                            bounds=bounds)
-        self.fitted_data = gaussian_2d((xx, yy), *popt).reshape(self.image.shape)
+        # mode 'fit': curve_fit seeded with the moment estimate, 'moments': moment estimate only (see moment_gaussians)
+        xy = coordinate_grid(self.image.shape)
+        data = self.image.ravel().astype(np.float64)
+        p0 = moment_gaussians(self.image[None])[0]
+
+        if mode == 'moments':
+            popt = p0
+        elif mode == 'fit':
+            bounds = (0, [np.inf, np.inf, np.inf, np.inf, np.inf, 2 * np.pi])
+            popt, _ = curve_fit(gaussian_2d, xy, data, p0=np.clip(p0, 0, bounds[1]), jac=gaussian_2d_jac, bounds=bounds)
+        else:
+            raise ValueError(f"mode must be one of these: 'fit' or 'moments', not {mode!r}")
+        self.fitted_data = gaussian_2d(xy, *popt).reshape(self.image.shape)
 
         self.I0, self.sigma_x, self.sigma_y = popt[0], popt[3], popt[4]
 
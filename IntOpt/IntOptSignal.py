@@ -1,5 +1,6 @@
 from static_trap import StaticTrap
 from complete_control_dev_class import AWG
+from waveform_store import load_signal
 import json
 import numpy as np
 
@@ -17,8 +18,7 @@ test.amp = amplitudes
 # test.amp[6] = 0
 test.get_signal()
 
-with open(test.filename, 'r') as f:
-    d = json.load(f)
+d = load_signal(test.filename)
 
 awg = AWG(time=test.duration)
 awg.transfer_data(50, d, 0)
@@ -0,0 +1,155 @@
+# Title: Camera session
+# Description:
+# 1. Camera keeps one EasyPySpin.VideoCapture open for the whole program and returns frames as numpy arrays,
+#    instead of opening the camera, writing a PNG and reading it back for every picture (old imcapture).
+# 2. The last frames are kept in a ring buffer (Camera.frames); frames are written to disk only when asked to, by a
+#    background thread, so the optimisation loop does not wait for the PNG encoder.
+# 3. ReplayCamera has the same interface and replays stored pictures (e.g. IntOptD/*.png) for testing without the
+#    camera; open_camera() returns it when the environment variable CAMERA_BACKEND=replay is set.
+
+import cv2
+import glob
+import os
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from PIL import Image
+
+try:
+    import EasyPySpin
+except ImportError:  # no Spinnaker SDK, only ReplayCamera is available
+    EasyPySpin = None
+
+BUFFER_SIZE = 16  # number of recent frames kept in memory
+REPLAY_DIR = './IntOptD'
+
+
+class FrameArchiver:
+    # writes (filepath, frame) pairs from a queue in a background thread
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            filepath, frame = item
+            try:
+                cv2.imwrite(filepath, frame)
+            except Exception as err:
+                print(f'Could not save {filepath}: {err}')
+            self.queue.task_done()
+
+    def save(self, filepath, frame):
+        self.queue.put((filepath, frame))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Camera:
+    def __init__(self, index=0, gain=-1, exposure=-1, buffer_size=BUFFER_SIZE):
+        if EasyPySpin is None:
+            raise RuntimeError('EasyPySpin is not installed, use ReplayCamera to run without the camera')
+        self.cap = EasyPySpin.VideoCapture(index)
+        if not self.cap.isOpened():
+            raise RuntimeError("Camera can't open")
+        self.frames = deque(maxlen=buffer_size)  # (time, frame) of the latest grabs
+        self.archiver = None
+        self.set_exposure(exposure)
+        self.set_gain(gain)
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+        self.cap.set(cv2.CAP_PROP_EXPOSURE, exposure)  # -1 sets exposure_time to auto
+
+    def set_gain(self, gain):
+        self.gain = gain
+        self.cap.set(cv2.CAP_PROP_GAIN, gain)  # -1 sets gain to auto
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            raise RuntimeError('Camera returned no frame')
+        return frame
+
+    def grab(self, filepath=None):
+        # latest frame as a numpy array; with filepath it is also saved, in the background
+        frame = self.read()
+        self.frames.append((time.time(), frame))
+        if filepath is not None:
+            self.archive(filepath, frame)
+        return frame
+
+    def archive(self, filepath, frame):
+        if self.archiver is None:
+            self.archiver = FrameArchiver()
+        self.archiver.save(filepath, frame)
+
+    def flush(self):
+        # wait until every archived frame is on disk
+        if self.archiver is not None:
+            self.archiver.flush()
+
+    def release(self):
+        self.cap.release()
+
+    def close(self):
+        if self.archiver is not None:
+            self.archiver.close()
+            self.archiver = None
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplayCamera(Camera):
+    # stand-in camera: returns the stored pictures matching `pattern` in turn (looping), gain and exposure are ignored
+    def __init__(self, directory=REPLAY_DIR, pattern='*.png', buffer_size=BUFFER_SIZE, loop=True):
+        self.files = sorted(glob.glob(os.path.join(directory, pattern)))
+        if not self.files:
+            raise RuntimeError(f'No pictures matching {pattern} in {directory}')
+        self.loop = loop
+        self.position = 0
+        self.frames = deque(maxlen=buffer_size)
+        self.archiver = None
+        self.gain, self.exposure = -1, -1
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def set_gain(self, gain):
+        self.gain = gain
+
+    def read(self):
+        if self.position >= len(self.files):
+            if not self.loop:
+                raise RuntimeError('No more pictures to replay')
+            self.position = 0
+        frame = np.array(Image.open(self.files[self.position]))
+        self.position += 1
+        return frame
+
+    def release(self):
+        pass
+
+
+def open_camera(**kwargs):
+    # Camera, or ReplayCamera over CAMERA_REPLAY_DIR (default ./IntOptD) when CAMERA_BACKEND=replay
+    if os.environ.get('CAMERA_BACKEND', '').lower() == 'replay':
+        return ReplayCamera(os.environ.get('CAMERA_REPLAY_DIR', REPLAY_DIR))
+    return Camera(**kwargs)
@@ -23,26 +23,15 @@ class Fitting():
             return False
 
     def start_fit(self):
-        # return the fitted amplitude
-        def gaussian_2d(xy, amplitude, x_mean, y_mean, x_stddev, y_stddev, rotation):
-            x, y = xy
-            x_rot = (x - x_mean) * np.cos(rotation) - (y - y_mean) * np.sin(rotation)
-            y_rot = (x - x_mean) * np.sin(rotation) + (y - y_mean) * np.cos(rotation)
-            exponent = -((x_rot / x_stddev) ** 2 + (y_rot / y_stddev) ** 2) / 2
-            return amplitude * np.exp(exponent)
-
-        x = np.arange(self.image.shape[1])
-        y = np.arange(self.image.shape[0])
-        xx, yy = np.meshgrid(x, y)
-
-        xy = (xx.flatten(), yy.flatten())
-        data = self.image.flatten()
+        # return the fitted amplitude, model, shared coordinate grid and analytic Jacobian from IntOptFnc
+        xy = coordinate_grid(self.image.shape)
+        data = self.image.ravel().astype(np.float64)
 
         bounds = (0, [np.inf, np.inf, np.inf, np.inf, np.inf, 2 * np.pi])
         popt, _ = curve_fit(gaussian_2d, xy, data, p0=[np.max(self.image), self.d//2, self.d//2, 10, 10, 0],
-                            bounds=bounds)
+                            jac=gaussian_2d_jac, bounds=bounds)
 
-        self.fitted_data = gaussian_2d((xx, yy), *popt).reshape(self.image.shape)
+        self.fitted_data = gaussian_2d(xy, *popt).reshape(self.image.shape)
         self.I0 = np.max(self.fitted_data)
 
     def show_image(self):
@@ -88,25 +77,11 @@ im = np.array(Image.open(f'IntOptD/example_i.png'))[450:510, 640-180:640+180]
 #     print(f'Initial ntrap = {ntrap} \n Initial RF amplitudes = {amplitudes}')
 #
 # if attempt == 0:
-#     # Find the local maxima using maximum_filter
+#     # Find the local maxima (see find_traps), excluding the borders and points that are too close to each other
 #     # Specify the positions in the first run, and use it thereafter in one optimization
 #     neighborhood_size = 50  # Define the size of the neighborhood for finding local maxima
-#     local_max = (im == maximum_filter(im, neighborhood_size))
-#     positions = np.flip(np.argwhere(local_max), axis=0)
-#     # positions = np.argwhere(local_max)
-
-
-# get rid of the points that are too close to each other
-# i = 0
-# while i < len(positions):
-#     if np.abs(positions[i][1] - positions[i-1][1]) < 5:
-#         positions = np.delete(positions, i, axis=0)
-#     elif positions[i][0] < 10 or positions[i][0] > 50:
-#         positions = np.delete(positions, i, axis=0)
-#     elif positions[i][1] < 15 or positions[i][1] > 345:
-#         positions = np.delete(positions, i, axis=0)
-#     else:
-#         i += 1
+#     positions = find_traps(im, neighborhood_size=neighborhood_size, border=(10, 15), min_separation=5)
+#     positions = np.rint(positions).astype(int)  # ascending column order, as in params_*.json and full.py
 # # maybe adjusting neighbourhood_size can help
 # if len(positions) > ntrap:
 #     print(f'Too many local maxima!!! -- {len(positions)}')
@@ -0,0 +1,66 @@
+# Title: Trap intensity equaliser
+# Description:
+# 1. Closed-loop update of the RF amplitudes so that every trap reaches the target intensity, replacing the fixed-rate
+#    rule A' = A + 0.1 * err * A of full.py.
+# 2. The response of the intensities to the amplitudes is kept as a Jacobian J = dI/dA (ntrap x ntrap). It starts from
+#    the single-tone model I ~ A^2 (J = diag(2 I / A)) and is corrected after every measurement with a Broyden rank-one
+#    update, so cross-talk between tones (shared AOD efficiency, intermodulation) is learnt from the iterations.
+# 3. Each step is a damped least-squares (Levenberg-Marquardt) step on J, limited to max_step of the amplitude; the
+#    damping grows when a step made the error worse (the amplitudes then fall back to the best point so far).
+# 4. Every iteration is recorded in IntensityEqualiser.log (amplitudes, intensities, error, damping, step).
+
+import numpy as np
+
+AMP_MAX = 0.3  # RF amplitude limit, larger values may damage the AOD (see full.py)
+
+
+class IntensityEqualiser:
+    def __init__(self, amp, target, lam=1e-2, max_step=0.3, amp_max=AMP_MAX):
+        self.amp = np.array(amp, dtype=np.float64)  # amplitudes being played
+        self.target = target  # intensity every trap should reach (0~255), scalar or per trap
+        self.lam = lam  # damping of the least-squares step
+        self.max_step = max_step  # largest relative amplitude change per iteration
+        self.amp_max = amp_max
+        self.jacobian = None
+        self.prev_amp, self.prev_intensity = None, None
+        self.best_amp, self.best_err = None, np.inf
+        self.log = []
+
+    def error(self, intensity):
+        return np.sqrt(np.mean((np.asarray(intensity, dtype=np.float64) - self.target) ** 2))
+
+    def update(self, intensity):
+        # intensity: measured with self.amp; returns the amplitudes to play next
+        intensity = np.asarray(intensity, dtype=np.float64)
+        err = self.error(intensity)
+        if self.jacobian is None:
+            self.jacobian = np.diag(2 * intensity / np.maximum(self.amp, 1e-12))
+        elif self.prev_amp is not None:
+            # Broyden: the new J reproduces the response to the last step exactly
+            da, di = self.amp - self.prev_amp, intensity - self.prev_intensity
+            if np.dot(da, da) > 0:
+                self.jacobian += np.outer(di - self.jacobian @ da, da) / np.dot(da, da)
+
+        if err <= self.best_err:
+            self.best_amp, self.best_err = np.copy(self.amp), err
+            self.lam = max(self.lam / 3, 1e-6)
+            base_amp, base_intensity = self.amp, intensity
+        else:
+            # worse than the best point so far: damp more and step again from there
+            self.lam *= 10
+            base_amp = self.best_amp
+            base_intensity = intensity + self.jacobian @ (self.best_amp - self.amp)
+
+        J = self.jacobian
+        residual = self.target - base_intensity
+        JTJ = J.T @ J
+        step = np.linalg.solve(JTJ + self.lam * np.diag(np.maximum(np.diag(JTJ), 1e-12)), J.T @ residual)
+        limit = self.max_step * base_amp
+        step = np.clip(step, -limit, limit)
+        new_amp = np.clip(base_amp + step, 0, self.amp_max)
+
+        self.log.append({'amp': self.amp.tolist(), 'intensity': intensity.tolist(), 'error': float(err),
+                         'std_intensity': float(np.std(intensity)), 'lam': float(self.lam), 'step': (new_amp - self.amp).tolist()})
+        self.prev_amp, self.prev_intensity = self.amp, intensity
+        self.amp = new_amp
+        return new_amp
@@ -13,23 +13,26 @@ Procedure:
 3. Optimization
     a. (Auto) Find the local maxima, and get rid of the points we do not want. Save the position.
     b. (Auto) Implement Gaussian fitting on each trap. Return the intensity (I) and beam waist (sigma_x, sigma_y).
-    c. (Auto) Correct each RF amplitude using the formula: A' = A + eta * err * A, where eta (= 0.1) is the learning rate, and err = (I_0 - I)/I_0 is the relative error.
+    c. (Auto) Correct the RF amplitudes with IntensityEqualiser (equaliser.py): a damped least-squares step towards I_0 on the
+       Jacobian dI/dA, which starts from I ~ A^2 and is refined (Broyden update) from every measurement.
     d. (Auto) Feed the new RF amplitude into AOD and (b), (c) iteratively. Once the stdev of intensity < 0.5, save the data and quit.
 '''
 
 from static_trap import StaticTrap
 from IntOptFnc import *
-from complete_control_dev_class import AWG
+from complete_control_dev_class import AWG, AWGController
+from waveform_cache import WaveformCache
+from camera import open_camera
+from equaliser import IntensityEqualiser
+from runner import IntOptRunner
 import cv2
 import os
 import sys
 import time
-import threading
 import json
 import numpy as np
 import matplotlib.pyplot as plt
 
-from PIL import Image
 from datetime import datetime
 
 # 1
@@ -48,28 +51,17 @@ print('===================================================')
 
 
 # generate single trap
+# repeated trap configurations are served from the cache instead of being resynthesised
+cache = WaveformCache()
 time.sleep(2)
 test = StaticTrap(ntrap=1, mode=phase_mode)
 test.amp = np.array([a_0])
-test.get_signal()
+d = cache.get_dac_signal(test)
 
-with open(test.filename, 'r') as f:
-    d = json.load(f)
-
-# threading
-stop_awg_flag = False
-def perform_awg():
-    global stop_awg_flag, test
-    awg = AWG(time=test.duration)
-    awg.transfer_data(50, d, 0)
-    awg.execute()
-    while not stop_awg_flag:
-        pass
-    awg.stop_AWG()
-    stop_awg_flag = False
-
-awg_thread = threading.Thread(target=perform_awg)
-awg_thread.start()
+# one AWG session for the whole program, driven by a worker thread: each new waveform is posted to it and swapped in
+# without reopening/resetting the card, and nothing spins while the card plays
+awg = AWGController(AWG(time=test.duration))
+awg.load(d).result()
 
 print('Single trap generated!')
 print('===================================================')
@@ -83,16 +75,20 @@ central_power = float(input('The power of the single trap (in mW): '))
 
 # adjust ccd gain
 frame_width = 30 # the area where the trap locates is d^2
+# peak intensity and waists from the log-Gaussian moments, no nonlinear fit per iteration ('fit' for the full fit);
+# the reference I0 below is measured the same way, as the two differ by a few percent
+fit_mode = 'moments'
 gain = 10
 central_I0 = 0
+# one camera session for the whole program, frames come back as arrays (CAMERA_BACKEND=replay to test without camera)
+cam = open_camera(gain=gain)
 print('Adjusting ccd gain...')
 while True:
-    image = imcapture('single_trap.png', gain)
-    im = np.array(Image.open(f'single_trap.png'))
-    os.remove('single_trap.png')
+    cam.set_gain(gain)
+    im = cam.grab()
 
     r = Fitting(im, [im.shape[0], im.shape[1]], frame_width)
-    r.start_fit()
+    r.start_fit(mode=fit_mode)
     if r.I0 < 150:
         gain += 1
     elif r.I0 > 200:
@@ -104,9 +100,8 @@ while True:
         break
 
 # stop AWG
-stop_awg_flag = True
-awg_thread.join()
-print('AWG closed')
+awg.stop().result()
+print('AWG stopped')
 print('===================================================')
 
 # 2
@@ -117,16 +112,12 @@ spacing = float(input("Input the lattice spacing (in MHz): "))
 time.sleep(2)
 test = StaticTrap(ntrap=ntrap, lattice_spacing=spacing, mode=phase_mode)
 test.amp = np.array([a_0 for _ in range(ntrap)])
-test.get_signal()
-
-with open(test.filename, 'r') as f:
-    signal = json.load(f)
+d = cache.get_dac_signal(test)
 
-awg_thread = threading.Thread(target=perform_awg)
-awg_thread.start()
+awg.load(d).result()
 
 # awg = AWG(time=test.duration)
-# awg.transfer_data(50, signal, 0)
+# awg.transfer_data(50, d, 0)
 # awg.execute()
 
 print('Adjust the gain to 24 in SpinView, and check if there is any strange pattern. \n Press enter to continue...')
@@ -143,39 +134,20 @@ os.makedirs(im_folder)
 
 # find local maxima
 print('Finding local maxima...')
-imcapture(f'{im_folder}/opt_{0}.png', gain)
-image = cv2.imread(f'{im_folder}/opt_{0}.png')
+image = cam.grab(f'{im_folder}/opt_{0}.png')  # archived in the background
 image_np = np.asarray(image)
 
-# Assuming traps are identifiable after preprocessing (thresholding, etc.)
-# Perform image processing steps here to identify the traps...
-
-# Example: Convert to grayscale and apply thresholding
-_, thresholded = cv2.threshold(image, 150, 200, cv2.THRESH_BINARY)
-
-# Find contours representing the traps
-contours, _ = cv2.findContours(thresholded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-# Extract trap positions
-trap_positions = []
-for contour in contours:
-    M = cv2.moments(contour)
-    if M["m00"] != 0:
-        cX = int(M["m10"] / M["m00"])  # x-coordinate of centroid
-        cY = int(M["m01"] / M["m00"])  # y-coordinate of centroid
-        trap_positions.append((cX, cY))
-
-# Convert trap_positions to NumPy array (optional)
-# not sure if this need to be flipped???
-trap_positions = np.array(trap_positions)
+# non-maximum suppression + border / min-separation filtering, sub-pixel (row, col) sorted by column (RF frequency);
+# the positions are validated here and reused in every iteration
+# the border also excludes the non-image pixels the camera writes at the start of row 0 (brighter than any trap)
+locator = TrapLocator(ntrap, border=(10, 15))
+trap_positions = locator.locate(image_np)  # raises ValueError if the number of maxima does not match ntrap
 print(f'Local maxima found: {trap_positions}')
 
 # plot and check if the local maxima are correct
 plt.imshow(image_np)
-plt.scatter(trap_positions[:, 0], trap_positions[:, 1], color='red', marker='o')
+plt.scatter(trap_positions[:, 1], trap_positions[:, 0], color='red', marker='o')
 plt.show()
-if trap_positions.shape[0] != ntrap:
-    raise Exception(f'Number of local maxima ({trap_positions.shape[0]}) does not match the number of traps ({ntrap})!!!')
 print('Press enter to continue...')
 input()
 
@@ -196,66 +168,18 @@ data = {
 }
 
 init_amp = test.amp
+equaliser = IntensityEqualiser(init_amp, central_I0)  # Jacobian (Broyden) damped least-squares amplitude updates
 print('Optimization start...')
-for i in range(25):
-    print(f'Iteration {i+1}')
-    imcapture(f'{im_folder}/opt_{i+1}')
-    image = cv2.imread(f'{im_folder}/opt_{0}.png')
-    image_np = np.asarray(image)
-
-    intensity, waist_x, waist_y = [], [], []
-    for j in range(ntrap):
-        r = Fitting(im, trap_positions[j], frame_width)
-        r.start_fit()
-
-        intensity.append(r.I0)
-        waist_x.append(r.sigma_x)
-        waist_y.append(r.sigma_y)
-
-    sigma_int, sigma_wx, sigma_wy = np.std(intensity), np.std(waist_x), np.std(waist_y)
-    if sigma_int <= 0.5:
-        print('Optimization complete!')
-        with open(f'{im_folder}/opt_log.json', 'w') as f:
-            json.dump(data, f)
-        print('Log created!')
-        sys.exit()
-
-    init_amp = np.array([init_amp[k] + 0.1 * (central_I0 - intensity[k]) / central_I0 * init_amp[k] for k in range(ntrap)])
-
-    stop_awg_flag = True
-    awg_thread.join()
-
-    # generate net trap:
-    time.sleep(2)
-    test = StaticTrap(ntrap=ntrap, lattice_spacing=spacing, mode=phase_mode)
-    test.amp = init_amp
-    test.get_signal()
-
-    with open(test.filename, 'r') as f:
-        signal = json.load(f)
-
-    awg_thread  = threading.Thread(target=perform_awg)
-    awg_thread.start()
-    # awg = AWG(time=test.duration)
-    # awg.transfer_data(50, signal, 0)
-    # awg.execute()
-
-    # store the data
-    data[f'iteration_{i+1}'] = {
-        'intensity': intensity,
-        'waist_x': waist_x,
-        'waist_y': waist_y,
-        'std_intensity': sigma_int,
-        'std_waist_x': sigma_wx,
-        'std_waist_y': sigma_wy,
-        'new_amp': np.ndarray.tolist(init_amp)
-    }
-
-
-stop_awg_flag = True
-awg_thread.join()
-print('Optimization end. May not complete')
+# capture -> fit -> update -> synthesis -> upload, frames and log written in the background, settle as a deadline
+runner = IntOptRunner(test, awg, cam, locator, equaliser, cache, frame_width=frame_width, fit_mode=fit_mode,
+                      settle=2.0, folder=im_folder, data=data)
+converged = runner.run(25, tol=0.5)
+runner.close()
+print('Mean stage times (s):', runner.stage_summary())
+
+awg.shutdown()
+cam.close()
+print('Optimization complete!' if converged else 'Optimization end. May not complete')
 with open(f'{im_folder}/opt_log.json', 'w') as f:
     json.dump(data, f)
 print('Log created!')
-
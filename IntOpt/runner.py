@@ -0,0 +1,109 @@
+# Title: Intensity optimisation runner
+# Description:
+# 1. One iteration of the feedback is capture -> fit -> new amplitudes -> synthesis -> upload -> settle, run in order
+#    (each step needs the result of the previous one). The JSON log is written by a background thread.
+# 2. Settling is a deadline (upload time + settle) instead of a fixed sleep.
+# 3. Every stage is timed (IntOptRunner.timings), per iteration: settle, capture, fit, update, synth, upload.
+# 4. close() waits for the log and frame writes; run() can be called again before it.
+
+import json
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from IntOptFnc import fit_traps
+
+SETTLE_TIME = 2.0  # s, between a new waveform and the next picture
+
+
+class IntOptRunner:
+    def __init__(self, trap, awg, camera, locator, equaliser, cache=None, frame_width=30, fit_mode='moments',
+                 settle=SETTLE_TIME, folder=None, data=None):
+        self.trap = trap  # StaticTrap, only its amplitudes change
+        self.awg = awg  # AWGController
+        self.camera = camera  # camera.Camera / ReplayCamera
+        self.locator = locator  # IntOptFnc.TrapLocator with validated positions
+        self.equaliser = equaliser  # equaliser.IntensityEqualiser
+        self.cache = cache  # waveform_cache.WaveformCache, None to synthesise every time
+        self.frame_width = frame_width
+        self.fit_mode = fit_mode
+        self.settle = settle
+        self.folder = folder  # frames and opt_log.json go here, None: nothing is archived
+        self.data = data if data is not None else {}
+        self.timings = []
+        self.archive = None  # single-thread executor of the log writes (keeps them in order), created by run
+
+    def timed(self, timing, name, func, *args):
+        t0 = time.perf_counter()
+        result = func(*args)
+        timing[name] = time.perf_counter() - t0
+        return result
+
+    def synthesise(self, amp):
+        self.trap.amp = amp
+        if self.cache is not None:
+            return self.cache.get_dac_signal(self.trap)
+        self.trap.get_signal(save=False)
+        return self.trap.get_dac_signal()
+
+    def upload(self, codes):
+        self.awg.load(codes).result()
+        return time.monotonic() + self.settle
+
+    def write_log(self, data):
+        with open(f'{self.folder}/opt_log.json', 'w') as f:
+            json.dump(data, f)
+
+    def run(self, iterations=25, tol=0.5, ready_at=None):
+        # ready_at: time.monotonic() from which the current waveform has settled, None: it already has
+        # returns True if the intensities became uniform (std <= tol)
+        ready_at = time.monotonic() if ready_at is None else ready_at
+        if self.folder is not None and self.archive is None:
+            self.archive = ThreadPoolExecutor(max_workers=1)
+        converged = False
+        start = len(self.timings)  # a further run continues the numbering of frames and log entries
+        for i in range(start, start + iterations):
+            timing = {}
+            t_start = time.perf_counter()
+            self.timed(timing, 'settle', time.sleep, max(0.0, ready_at - time.monotonic()))
+            filepath = f'{self.folder}/opt_{i+1}.png' if self.folder is not None else None
+            image = self.timed(timing, 'capture', self.camera.grab, filepath)
+            intensity, waist_x, waist_y = self.timed(timing, 'fit', fit_traps, image, self.locator.positions,
+                                                     self.frame_width, self.fit_mode)
+            std_int = float(np.std(intensity))
+            print(f'Iteration {i+1}: std of intensity = {std_int:.3f}')
+            record = {'intensity': intensity.tolist(), 'waist_x': waist_x.tolist(), 'waist_y': waist_y.tolist(),
+                      'std_intensity': std_int, 'std_waist_x': float(np.std(waist_x)),
+                      'std_waist_y': float(np.std(waist_y))}
+
+            converged = std_int <= tol
+            if not converged:
+                amp = self.timed(timing, 'update', self.equaliser.update, intensity)
+                record['new_amp'] = amp.tolist()
+                record['jacobian'] = self.equaliser.jacobian.tolist()
+            self.data[f'iteration_{i+1}'] = record
+            self.data['trajectory'] = self.equaliser.log
+            if self.folder is not None:
+                self.archive.submit(self.write_log, json.loads(json.dumps(self.data)))  # snapshot, written meanwhile
+            if converged:
+                timing['total'] = time.perf_counter() - t_start
+                self.timings.append(timing)
+                break
+
+            codes = self.timed(timing, 'synth', self.synthesise, amp)
+            ready_at = self.timed(timing, 'upload', self.upload, codes)
+            timing['total'] = time.perf_counter() - t_start
+            self.timings.append(timing)
+        return converged
+
+    def close(self):
+        # wait for the background writes (log and frames)
+        if self.archive is not None:
+            self.archive.shutdown(wait=True)
+            self.archive = None
+        self.camera.flush()
+
+    def stage_summary(self):
+        # mean seconds per stage over the iterations
+        names = sorted({name for timing in self.timings for name in timing})
+        return {name: float(np.mean([timing.get(name, 0.0) for timing in self.timings])) for name in names}
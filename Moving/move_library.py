@@ -0,0 +1,122 @@
+# Title: Precompiled move-waveform library
+# Description:
+# 1. Rearrangement only uses moves between sites of a fixed frequency grid (LATTICE_SPACING in moving_alogrithm.py)
+#    with a few durations, so every (start site, end site, duration) chirp is rendered once (get_move_phase in
+#    moving.py, unit amplitude, phase continuous with the static trap phases) and stored as float32 rows of one .npy
+#    file per duration, next to a JSON index (site grid, phases, row of every pair).
+# 2. A rearrangement waveform is then a weighted sum of stored rows: no sine is evaluated per shot.
+# 3. Size: pairs * R * duration * 4 bytes per duration, use max_shift to keep only moves of up to that many sites.
+# 4. build() adds its durations to those already in the directory (same sites and rate only).
+
+import numpy as np
+import json
+import os
+
+from moving import R, chirp_profile, get_move_phase
+
+LIBRARY_DIR = '../Data/move_library'
+BUILD_BLOCK = 2 ** 22  # samples x tones rendered per pass when building
+
+
+class MoveLibrary:
+    def __init__(self, directory=LIBRARY_DIR):
+        self.directory = directory
+        self.index = None
+        self.tones = {}  # duration -> (pairs, samples) float32 memmap
+        self.rows = {}  # duration -> {(start site, end site): row}
+        self.ramp = {}  # duration -> g(u), amplitude ramp shared by all tones
+        if os.path.exists(self.index_filename()):
+            self.load()
+
+    def index_filename(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def duration_key(self, duration):
+        # exact text of the duration (float(key) == duration), '{:g}' would merge durations beyond 6 digits
+        return repr(float(duration))
+
+    def tone_filename(self, duration):
+        return os.path.join(self.directory, 'moves_{0}us.npy'.format(self.duration_key(duration)))
+
+    def build(self, site_freq, site_phase, durations, max_shift=None, rate=R):
+        # site_freq, site_phase: frequency (MHz) and phase (rad) of the static trap at every site
+        site_freq, site_phase = np.asarray(site_freq, dtype=np.float64), np.asarray(site_phase, dtype=np.float64)
+        nsite = len(site_freq)
+        start, end = np.meshgrid(np.arange(nsite), np.arange(nsite), indexing='ij')
+        keep = np.ones(start.shape, dtype=bool) if max_shift is None else np.abs(end - start) <= max_shift
+        pairs = np.stack((start[keep], end[keep]), axis=1)
+
+        os.makedirs(self.directory, exist_ok=True)
+        index = {'rate': rate, 'site_freq': site_freq.tolist(), 'site_phase': site_phase.tolist(), 'durations': {}}
+        if os.path.exists(self.index_filename()):
+            # add to the durations built before, which only makes sense on the same site grid
+            with open(self.index_filename(), 'r') as f:
+                old = json.load(f)
+            if (old['rate'] != rate or len(old['site_freq']) != nsite or not np.allclose(old['site_freq'], site_freq)
+                    or not np.allclose(old['site_phase'], site_phase)):
+                raise ValueError(f'The library in {self.directory} was built for other sites or rate, '
+                                 'use another directory or delete it first.')
+            index['durations'] = old['durations']
+        for duration in durations:
+            self.tones.pop(float(duration), None)  # release the old memmap before its file is rewritten
+            for key in [key for key in index['durations'] if float(key) == float(duration)]:
+                del index['durations'][key]
+            signal_length = int(round(rate * duration))
+            time = np.arange(signal_length) / rate
+            tones = np.lib.format.open_memmap(self.tone_filename(duration), mode='w+', dtype=np.float32,
+                                              shape=(len(pairs), signal_length))
+            block = max(1, BUILD_BLOCK // max(signal_length, 1))
+            for k in range(0, len(pairs), block):
+                s, e = pairs[k:k + block, 0], pairs[k:k + block, 1]
+                phase = get_move_phase(time, duration, site_freq[s], site_freq[e], site_phase[s], site_phase[e])
+                tones[k:k + block] = np.sin(phase).T
+            tones.flush()
+            del tones
+            index['durations'][self.duration_key(duration)] = {
+                'file': os.path.basename(self.tone_filename(duration)), 'pairs': pairs.tolist()}
+            print(f'Move library: {len(pairs)} moves of {duration} us')
+        with open(self.index_filename(), 'w') as f:
+            json.dump(index, f)
+        self.load()
+
+    def load(self):
+        with open(self.index_filename(), 'r') as f:
+            self.index = json.load(f)
+        self.site_freq = np.array(self.index['site_freq'])
+        self.site_phase = np.array(self.index['site_phase'])
+        self.tones, self.rows, self.ramp = {}, {}, {}
+        for key, entry in self.index['durations'].items():
+            duration = float(key)
+            self.tones[duration] = np.load(os.path.join(self.directory, entry['file']), mmap_mode='r')
+            self.rows[duration] = {(s, e): row for row, (s, e) in enumerate(entry['pairs'])}
+            time = np.arange(self.tones[duration].shape[1]) / self.index['rate']
+            self.ramp[duration] = chirp_profile(time / duration)[0].astype(np.float32)
+
+    def site(self, freq):
+        # nearest grid site of a frequency (MHz), e.g. the entries of MovingAlgo_1.transition_list
+        return np.abs(self.site_freq[:, None] - np.atleast_1d(freq)).argmin(axis=0)
+
+    def assemble(self, moves, duration, a_i=1.0, a_f=None):
+        # moves: (start site, end site) per tone; a_i, a_f: per-tone start/end amplitude, ramped like get_move_signal
+        # returns the float signal in [-sum(a), sum(a)], scale it like StaticTrap.signal before transfer
+        duration = float(duration)
+        if duration not in self.tones:
+            raise ValueError(f'No moves of {duration:g} us in the library, built durations: {sorted(self.tones)}')
+        try:
+            rows = [self.rows[duration][(int(s), int(e))] for s, e in moves]
+        except KeyError as err:
+            raise ValueError(f'Move {err.args[0]} is not in the library (max_shift?)') from None
+        a_i = np.broadcast_to(np.asarray(a_i, dtype=np.float32), (len(rows),))
+        a_f = a_i if a_f is None else np.broadcast_to(np.asarray(a_f, dtype=np.float32), (len(rows),))
+        perm = np.argsort(rows)  # read the rows in file order, amplitudes follow the same permutation
+        tones = self.tones[duration][np.asarray(rows, dtype=np.int64)[perm]]
+        signal = a_i[perm] @ tones
+        if np.any(a_f != a_i):
+            signal += self.ramp[duration] * ((a_f - a_i)[perm] @ tones)
+        return signal
+
+    def assemble_transitions(self, transition_list, duration, a_i=1.0, a_f=None):
+        # [[start freq, end freq], ...] as produced by MovingAlgo_1.calculation
+        freqs = np.asarray(transition_list, dtype=np.float64).reshape(-1, 2)
+        moves = np.stack((self.site(freqs[:, 0]), self.site(freqs[:, 1])), axis=1)
+        return self.assemble(moves, duration, a_i, a_f)
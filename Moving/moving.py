@@ -6,12 +6,82 @@
 
 import numpy as np
 import json
+import os
+
+
+R = 625  # sampling rate, unit: MHz
+CHUNK_SIZE = 1024  # number of samples rendered per pass in get_move_signal, bounds the (samples x tones) work array
+
+
+def chirp_profile(u):
+    # normalised piecewise quadratic frequency ramp g(u) = (f(t) - f_i) / (f_f - f_i), u = t / duration, and its integral G(u)
+    # g(u) = 2u^2 for u < 1/2, 1 - 2(1-u)^2 otherwise: zero slope at both ends, same curve as Move.get_cont_freq
+    u = np.asarray(u, dtype=np.float64)
+    first = u < 0.5
+    g = np.where(first, 2 * u ** 2, 1 - 2 * (1 - u) ** 2)
+    G = np.where(first, 2 * u ** 3 / 3, u - 0.5 + 2 * (1 - u) ** 3 / 3)
+    return g, G
+
+
+def phase_correction(u):
+    # smooth 0 -> 1 step with zero slope at both ends, spreads the end-phase correction without a frequency jump
+    u = np.asarray(u, dtype=np.float64)
+    return u ** 2 * (3 - 2 * u)
+
+
+def get_move_coeff(duration, f_i, f_f, p_i, p_f):
+    # (4, tones) matrix such that phase = [t, duration * G(u), s(u), 1] @ coeff
+    f_i, f_f = np.asarray(f_i, dtype=np.float64), np.asarray(f_f, dtype=np.float64)
+    p_i, p_f = np.asarray(p_i, dtype=np.float64), np.asarray(p_f, dtype=np.float64)
+    p_end = p_i + 2 * np.pi * duration * (f_i + f_f) / 2  # integral of the ramp is duration * f_m
+    delta = np.angle(np.exp(1j * (p_f - p_end)))
+    return np.stack(np.broadcast_arrays(2 * np.pi * f_i, 2 * np.pi * (f_f - f_i), delta, p_i)).reshape(4, -1)
+
+
+def move_basis(time, duration):
+    time = np.asarray(time, dtype=np.float64)
+    u = time / duration
+    return np.stack((time, duration * chirp_profile(u)[1], phase_correction(u), np.ones_like(time)), axis=-1)
+
+
+def get_move_phase(time, duration, f_i, f_f, p_i, p_f):
+    # phase of every tone at every sample, (samples, tones)
+    # phase(t) = p_i + 2 pi * integral_0^t f + delta * s(t / duration), where delta is the wrapped mismatch between the
+    # integrated phase at t = duration and p_f, so each tone leaves with exactly the phase of the static trap it ends in
+    coeff = get_move_coeff(duration, f_i, f_f, p_i, p_f)
+    return move_basis(time, duration) @ coeff
+
+
+def get_move_signal(duration, f_i, f_f, p_i, p_f, a_i, a_f=None, rate=R, dtype=np.float64, chunk_size=CHUNK_SIZE):
+    # Sum over tones of a(t) * sin(phase(t)) for a move of `duration` us, all tones rendered together.
+    # f_*, p_*, a_*: per-tone start/end frequency (MHz), phase (rad) and amplitude. The amplitude follows the
+    # frequency ramp, a(t) = a_i + (a_f - a_i) g(u); a_f=None keeps it constant.
+    signal_length = int(round(rate * duration))
+    a_i = np.asarray(a_i, dtype=np.float64)
+    a_f = a_i if a_f is None else np.asarray(a_f, dtype=np.float64)
+    coeff = get_move_coeff(duration, f_i, f_f, p_i, p_f)
+    a_i, a_f = np.broadcast_to(a_i, coeff.shape[1:]), np.broadcast_to(a_f, coeff.shape[1:])
+
+    signal = np.zeros(signal_length, dtype=dtype)
+    for start in range(0, signal_length, chunk_size):
+        time = np.arange(start, min(start + chunk_size, signal_length)) / rate
+        basis = move_basis(time, duration)
+        # phase relative to the chunk start plus the start phase reduced mod 2 pi: small arguments keep np.sin fast
+        phase = (basis - basis[0]) @ coeff
+        phase += np.mod(basis[0] @ coeff, 2 * np.pi)
+        tones = np.sin(phase)
+        # a(t) = a_i + (a_f - a_i) g: two weighted sums over the tones instead of a per-tone envelope
+        g = chirp_profile(time / duration)[0]
+        signal[start:start + len(time)] = tones @ a_i + g * (tones @ (a_f - a_i))
+    return signal
 
 
 filename = "../Data/static_trap_parameters_20230920_151601.json"
-with open(filename, "r") as json_file:
-    loaded_data = json.load(json_file)
-    ntrap, freq, amp, phase = loaded_data[0], loaded_data[1], loaded_data[2], loaded_data[3]
+ntrap, freq, amp, phase = 0, [], [], []
+if os.path.exists(filename):
+    with open(filename, "r") as json_file:
+        loaded_data = json.load(json_file)
+        ntrap, freq, amp, phase = loaded_data[0], loaded_data[1], loaded_data[2], loaded_data[3]
 
 class Move:
     def __init__(self, f, p, a, t):
@@ -22,48 +92,69 @@ class Move:
         self.t = t  # moving time
 
         # coefficients of frequency interpolation functions
-        self.cf_1, self.cf_2 = np.array([0 for _ in range(3)]), np.array([0 for _ in range(3)])
-        self.signal_length = self.R * self.t
-        self.cont_freq = np.array([0.0 for _ in range(self.signal_length)])
-        self.cont_amp = np.array([0.0 for _ in range(self.signal_length)])
-        self.signal = np.array([0.0 for _ in range(self.signal_length)])
+        self.cf_1, self.cf_2 = np.zeros(3), np.zeros(3)
+        self.signal_length = int(round(self.R * self.t))
+        self.time = np.arange(self.signal_length) / self.R  # unit: us
+        self.cont_freq = np.zeros(self.signal_length)
+        self.cont_amp = np.zeros(self.signal_length)
+        self.signal = np.zeros(self.signal_length)
 
     def get_cont_freq(self):
         f_m = (self.f_i + self.f_f) / 2  # middle frequency between 2 interpolation curve
         self.cf_1 = np.linalg.solve(np.array([[1, 0, 0], [1, self.t/2, (self.t/2)**2], [0, 1, 0]]), np.array([self.f_i, f_m, 0]))
         self.cf_2 = np.linalg.solve(np.array([[1, self.t/2, (self.t/2)**2], [1, self.t, self.t**2], [0, 1, 2*self.t]]), np.array([f_m, self.f_f, 0]))
 
-        for i in range(self.signal_length):
-            if i < self.signal_length / 2:
-                self.cont_freq[i] = self.cf_1[0] + self.cf_1[1] * i / self.R + self.cf_1[2] * (i / self.R) ** 2
-            else:
-                self.cont_freq[i] = self.cf_2[0] + self.cf_2[1] * i / self.R + self.cf_2[2] * (i / self.R) ** 2
+        # Horner evaluation of each quadratic on its half of the time axis (samples i < signal_length / 2 use cf_1)
+        half = (self.signal_length + 1) // 2
+        for cf, sl in ((self.cf_1, slice(0, half)), (self.cf_2, slice(half, None))):
+            out, t = self.cont_freq[sl], self.time[sl]
+            np.multiply(t, cf[2], out=out)
+            out += cf[1]
+            out *= t
+            out += cf[0]
 
     def get_transit_time(self):
         pass
 
-    def get_cont_amp(self):
-        for i in range(self.signal_length):
-            f = self.cont_freq[i]
-            for j in range(len(freq)):
-                if freq[j] <=  f <= freq[j+1]:
-                    self.cont_amp[i] = amp[j] + (amp[j+1] - amp[j]) * (f - freq[j]) / (freq[j+1] - freq[j])
-
-
-
-    def get_signal(self):
-        pass
-
-a = Move(f=(125, 75), p=(0, 0), a=[1, 1, 1], t=3000)
-a.get_cont_freq()
-
-# fn = "test.json"
-# with open(fn, "w") as json_file:
-#     json.dump(a.cont_freq.tolist(), json_file)
-
-from matplotlib import pyplot as plt
-plt.plot(a.cont_freq)
-plt.show()
+    def get_cont_amp(self, static_freq=None, static_amp=None):
+        # linear interpolation of the static trap amplitudes at the instantaneous frequency, 0 outside the array
+        static_freq = freq if static_freq is None else static_freq
+        static_amp = amp if static_amp is None else static_amp
+        self.cont_amp.fill(0.0)
+        if len(static_freq) == 0:
+            return
+        # same result as np.interp(self.cont_freq, static_freq, static_amp, left=0, right=0), but cont_freq is monotonic,
+        # so every interval [static_freq[j], static_freq[j+1]] is one contiguous slice found with two binary searches
+        static_freq, static_amp = np.asarray(static_freq, dtype=np.float64), np.asarray(static_amp, dtype=np.float64)
+        rising = self.cont_freq[-1] >= self.cont_freq[0]
+        f = self.cont_freq if rising else self.cont_freq[::-1]
+        a = self.cont_amp if rising else self.cont_amp[::-1]
+        lo = np.searchsorted(f, static_freq, side='left')
+        hi = np.searchsorted(f, static_freq, side='right')
+        slope = np.diff(static_amp) / np.diff(static_freq)
+        for j in range(len(static_freq) - 1):
+            sl = slice(lo[j], hi[j+1])
+            np.subtract(f[sl], static_freq[j], out=a[sl])
+            a[sl] *= slope[j]
+            a[sl] += static_amp[j]
+
+    def get_signal(self, amp=None):
+        # amp: amplitude per sample, defaults to self.cont_amp (see get_cont_amp)
+        amp = self.cont_amp if amp is None else amp
+        phase = get_move_phase(self.time, self.t, self.f_i, self.f_f, self.p_i, self.p_f)[:, 0]
+        self.signal = amp * np.sin(phase)
+
+if __name__ == '__main__':
+    a = Move(f=(125, 75), p=(0, 0), a=[1, 1, 1], t=3000)
+    a.get_cont_freq()
+
+    # fn = "test.json"
+    # with open(fn, "w") as json_file:
+    #     json.dump(a.cont_freq.tolist(), json_file)
+
+    from matplotlib import pyplot as plt
+    plt.plot(a.cont_freq)
+    plt.show()
 
 
 
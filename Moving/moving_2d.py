@@ -0,0 +1,133 @@
+# 2D AOD Moving Algorithm
+# Input: occupancy matrix of the loaded array, occ[y, x] = 1 if the trap at column x, row y holds an atom
+# Output: movement steps in the process_list format of generate_freq_list_20220505.py, forming a filled core array
+# 1. fill_atoms: random partially filled array (simulation)
+# 2. pre_sorting: move the atoms of each column vertically so that every core row gets enough atoms (one step per column)
+# 3. form_core_array: move the atoms of each core row horizontally onto the core columns (one step per row)
+# A step moves all atoms of one column (several y tones, one x tone) or one row (several x tones, one y tone) together,
+# keeps their order (no crossing) and takes transit_time * (largest displacement of the step).
+
+
+import numpy as np
+
+TRANSIT_TIME = 1000  # unit: us, time to shift one coordinate unit, as in generate_freq_list_20220505.py
+
+
+def fill_atoms(nrow, ncol, load_prob=.55):
+    return (np.random.rand(nrow, ncol) < load_prob).astype(int)
+
+
+def core_band(n, size):
+    # centred index range [lo, hi) of the core along one axis
+    lo = (n - size) // 2
+    return lo, lo + size
+
+
+def block_target(pos, lo, hi, n, weight=None):
+    # Targets for the sorted occupied sites `pos` of one line: a contiguous block (order preserving, no crossing) that
+    # lies inside the band [lo, hi) if the atoms fit, or covers it otherwise. Among the allowed block positions the one
+    # with the least weight (sum over the block, used to balance rows in pre_sorting), then the smallest maximum and
+    # total displacement is taken.
+    k = len(pos)
+    if k == 0:
+        return pos
+    if k <= hi - lo:
+        s_min, s_max = lo, hi - k
+    else:
+        s_min, s_max = max(0, hi - k), min(lo, n - k)
+    s = np.arange(s_min, s_max + 1)
+    target = s[:, None] + np.arange(k)
+    disp = np.abs(target - pos)
+    keys = (disp.sum(axis=1), disp.max(axis=1))
+    if weight is not None and k < hi - lo:
+        keys = keys + (weight[target].sum(axis=1),)
+    return target[np.lexsort(keys)[0]]
+
+
+def pre_sorting(occ, core_shape, transit_time=TRANSIT_TIME):
+    # vertical compaction of every column onto the core rows, fullest columns first, the shorter ones then go to the
+    # core rows with the fewest atoms so far
+    occ = np.array(occ, dtype=int)
+    nrow, ncol = occ.shape
+    lo, hi = core_band(nrow, core_shape[0])
+    row_count = np.zeros(nrow, dtype=int)
+    movement_return_list, step_time = [], []
+    for x in np.argsort(occ.sum(axis=0), kind='stable')[::-1]:
+        pos = np.flatnonzero(occ[:, x])
+        target = block_target(pos, lo, hi, nrow, row_count)
+        row_count[target] += 1
+        if np.array_equal(pos, target):
+            continue
+        occ[:, x] = 0
+        occ[target, x] = 1
+        movement_return_list.append([[(int(x), int(y)) for y in pos], [(int(x), int(y)) for y in target]])
+        step_time.append(transit_time * int(np.abs(target - pos).max()))
+    return occ, movement_return_list, step_time
+
+
+def form_core_array(occ, core_shape, transit_time=TRANSIT_TIME):
+    # horizontal compaction of every core row onto the core columns
+    occ = np.array(occ, dtype=int)
+    nrow, ncol = occ.shape
+    row_lo, row_hi = core_band(nrow, core_shape[0])
+    lo, hi = core_band(ncol, core_shape[1])
+    movement_return_list, step_time = [], []
+    for y in range(row_lo, row_hi):
+        pos = np.flatnonzero(occ[y])
+        target = block_target(pos, lo, hi, ncol)
+        if np.array_equal(pos, target):
+            continue
+        occ[y] = 0
+        occ[y, target] = 1
+        movement_return_list.append([[(int(x), int(y)) for x in pos], [(int(x), int(y)) for x in target]])
+        step_time.append(transit_time * int(np.abs(target - pos).max()))
+    return occ, movement_return_list, step_time
+
+
+def core_filled(occ, core_shape):
+    row_lo, row_hi = core_band(occ.shape[0], core_shape[0])
+    col_lo, col_hi = core_band(occ.shape[1], core_shape[1])
+    return bool(occ[row_lo:row_hi, col_lo:col_hi].all())
+
+
+class MovingAlgo_2:
+    # Algorithm 2: partially filled 2D array -> filled rectangular core array in the centre
+    def __init__(self, nrow=20, ncol=20, load_prob=.55, core_shape=None, transit_time=TRANSIT_TIME):
+        self.init_atom_in_trap = fill_atoms(nrow, ncol, load_prob)  # simulation, replace by the camera occupancy
+        self.core_shape = core_shape  # (rows, columns), None: largest square core that can be filled
+        self.transit_time = transit_time
+        self.final_atom_in_trap = np.copy(self.init_atom_in_trap)
+        self.process_list = []  # input for generate_freq_list / the AWG, one [[start points], [end points]] per step
+        self.step_time = []  # unit: us, duration of every step
+        self.filled = False
+
+    def plan(self, core_shape):
+        presorted, steps_1, time_1 = pre_sorting(self.init_atom_in_trap, core_shape, self.transit_time)
+        final, steps_2, time_2 = form_core_array(presorted, core_shape, self.transit_time)
+        return final, steps_1 + steps_2, time_1 + time_2
+
+    def calculation(self):
+        if self.core_shape is not None:
+            shapes = [self.core_shape]
+        else:
+            side = int(np.sqrt(self.init_atom_in_trap.sum()))
+            shapes = [(s, s) for s in range(min(side, *self.init_atom_in_trap.shape), 0, -1)] or [(0, 0)]
+        for core_shape in shapes:
+            final, steps, step_time = self.plan(core_shape)
+            if core_filled(final, core_shape) or core_shape is shapes[-1]:
+                break
+        self.core_shape = core_shape
+        self.final_atom_in_trap, self.process_list, self.step_time = final, steps, step_time
+        self.filled = core_filled(final, core_shape)
+
+    def stats(self):
+        return {'core_shape': self.core_shape, 'filled': self.filled, 'steps': len(self.process_list),
+                'total_time': sum(self.step_time), 'atoms': int(self.init_atom_in_trap.sum())}
+
+
+if __name__ == '__main__':
+    test = MovingAlgo_2()
+    test.calculation()
+    print(test.init_atom_in_trap)
+    print(test.final_atom_in_trap)
+    print(test.stats())
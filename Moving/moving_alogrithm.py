@@ -10,45 +10,112 @@ CENTRAL_FREQ = 75.0  # unit: MHz, denotes the frequency for the coordinate 0
 LATTICE_SPACING = 0.5  # unit: MHz, denotes the frequency spacing between neighboring coordinate points (min: 0.45 MHz in Lukin's paper)
 
 
+def plan_1d(atom, target, mode='greedy'):
+    # Assignment of atoms to target sites, returns (source site, target site) arrays of the filled targets.
+    # atom, target: 0/1 per site
+    # mode 'greedy': MovingAlgo_1 rule, the targets are filled from left to right, each with the first still unused atom
+    #   at or to the right of it. With t_m the m-th target and r_m the rank of its atom among the occupied sites,
+    #   r_m = max(first atom >= t_m, r_{m-1} + 1), i.e. r_m = m + cummax(searchsorted(atoms, t_m) - m).
+    # mode 'min_total' / 'min_max': order preserving (crossing free) matching with the least total / largest
+    #   displacement, see match_1d. As many targets as possible are filled.
+    atoms = np.flatnonzero(atom)
+    targets = np.flatnonzero(target)
+    if mode == 'greedy':
+        m = np.arange(len(targets))
+        rank = m + np.maximum.accumulate(np.searchsorted(atoms, targets) - m) if len(targets) else m
+        filled = rank < len(atoms)  # targets past the last usable atom stay empty
+        return atoms[rank[filled]], targets[filled]
+    if mode not in ('min_total', 'min_max'):
+        raise ValueError(f"mode must be one of these: 'greedy', 'min_total', or 'min_max', not {mode!r}")
+    if len(atoms) >= len(targets):
+        return atoms[match_1d(atoms, targets, mode)], targets
+    return atoms, targets[match_1d(targets, atoms, mode)]
+
+
+def match_1d(a, b, mode='min_total'):
+    # Order preserving matching of every b to a distinct a (len(a) >= len(b), both sorted): b[j] -> a[j + d_j] with
+    # 0 <= d_0 <= d_1 <= ... <= len(a) - len(b), an optimal matching on a line never needs crossings.
+    # 'min_total': least total displacement. 'min_max': least largest displacement, then least total displacement
+    # among those (a first pass finds the least largest displacement, the second minimises the total with every
+    # displacement above it forbidden). O(len(b) * (len(a) - len(b) + 1)) per pass in numpy, see match_dp.
+    n, m = len(a), len(b)
+    if m == 0:
+        return np.zeros(0, dtype=int)
+    skip = np.arange(n - m + 1)
+    disp = np.abs(a[np.arange(m)[:, None] + skip] - b[:, None]).astype(np.int64)  # disp[j, d] = |a[j + d] - b[j]|
+    if mode == 'min_max':
+        largest = match_dp(disp, np.maximum)[0].min()
+        forbidden = np.int64(m) * (disp.max() + 1)  # > any allowed total
+        disp = np.where(disp <= largest, disp, forbidden)
+    cost, back = match_dp(disp, np.add)
+    d = np.empty(m, dtype=np.int64)
+    d[-1] = np.argmin(cost)
+    for j in range(m - 1, 0, -1):
+        d[j - 1] = back[j][d[j]]
+    return np.arange(m) + d
+
+
+def match_dp(disp, combine):
+    # Dynamic program over j, vectorised over the skip d: cost_j[d] = combine(min_{d' <= d} cost_{j-1}[d'], disp[j, d]).
+    # Returns the last cost row and the back pointers (the d' of the minimum, for every j and d).
+    cost = np.zeros(disp.shape[1], dtype=np.int64)
+    skip = np.arange(disp.shape[1])
+    back = np.zeros(disp.shape, dtype=np.int64)
+    for j in range(disp.shape[0]):
+        best = np.minimum.accumulate(cost)
+        back[j] = np.maximum.accumulate(np.where(cost == best, skip, 0))  # argmin over d' <= d
+        cost = combine(best, disp[j])
+    return cost, back
+
+
 class MovingAlgo_1:
     # Algorithm 1: equal spacing traps -> specific configuration (pairs of traps of our interest)
     def __init__(self, ntrap=60, load_prob=.55):
         self.ntrap = ntrap
-        self.init_freq_config = np.array([CENTRAL_FREQ + 0.5*(i-0.5*(-1+self.ntrap)) for i in range(self.ntrap)])  # initial trap layout
-        self.init_atom_in_trap = np.array([np.random.choice([0, 1], p=[1-load_prob, load_prob]) for _ in range(self.ntrap)])  # simulation: if the atoms are in the trap
+        site = np.arange(self.ntrap)
+        self.init_freq_config = CENTRAL_FREQ + 0.5*(site-0.5*(-1+self.ntrap))  # initial trap layout
+        self.init_atom_in_trap = (np.random.rand(self.ntrap) < load_prob).astype(int)  # simulation: if the atoms are in the trap
 
-        self.final_trap_on = np.array([1 if (i%4==0 or i%4==1) else 0 for i in range(self.ntrap)])  # desired layout
+        self.final_trap_on = ((site%4==0) | (site%4==1)).astype(int)  # desired layout
         # 1: start freq, 2: final freq of a list of traps
-        self.final_freq_config_1 = np.array([0.0 for _ in range(self.ntrap)])
-        self.final_freq_config_2 = np.array([CENTRAL_FREQ + 0.5*(i-0.5*(-1+self.ntrap)) if (i%4==0 or i%4==1) else 0 for i in range(self.ntrap)])
+        self.final_freq_config_1 = np.zeros(self.ntrap)
+        self.final_freq_config_2 = np.where(self.final_trap_on == 1, self.init_freq_config, 0.0)
         self.final_atom_in_trap = np.copy(self.init_atom_in_trap)  # to be manipulated: final trap configuration
         self.transition_list = []
+        self.transition_src, self.transition_dst = np.zeros(0, dtype=int), np.zeros(0, dtype=int)  # site indices
+
+    def calculation(self, mode='greedy'):
+        # greedy: every target takes the first unused atom at or to its right, see plan_1d for the other modes
+        # atoms left on non-target sites are dropped
+        src, dst = plan_1d(self.init_atom_in_trap, self.final_trap_on, mode)
+        self.transition_src, self.transition_dst = src, dst
+        self.final_atom_in_trap = np.zeros(self.ntrap, dtype=int)
+        self.final_atom_in_trap[dst] = 1
+        self.final_freq_config_1[dst] = self.init_freq_config[src]
+        self.transition_list = np.stack((self.final_freq_config_1[dst], self.final_freq_config_2[dst]), axis=1)
+
+
+def benchmark(sizes=(60, 100, 300, 1000), load_prob=.55, repeat=100, mode='greedy'):
+    # mean planning time per shot, the atom pattern is redrawn every repetition
+    import time
+    for ntrap in sizes:
+        test = MovingAlgo_1(ntrap=ntrap, load_prob=load_prob)
+        elapsed = 0.0
+        for _ in range(repeat):
+            test.init_atom_in_trap = (np.random.rand(ntrap) < load_prob).astype(int)
+            t0 = time.perf_counter()
+            test.calculation(mode)
+            elapsed += time.perf_counter() - t0
+        shift = np.abs(test.transition_dst - test.transition_src)
+        print(f'{mode}, ntrap = {ntrap}: {1e6 * elapsed / repeat:.1f} us per plan, {len(test.transition_list)} moves, '
+              f'total shift {shift.sum()}, max shift {shift.max() if len(shift) else 0}')
+
 
-    def calculation(self):
-        # may be simplified to speedup
-        k = 0
-        while k < self.ntrap:
-            if self.final_atom_in_trap[k] == 1 and self.final_trap_on[k] == 1:
-                self.final_freq_config_1[k] = self.init_freq_config[k]
-                self.transition_list.append([self.final_freq_config_1[k], self.final_freq_config_2[k]])
-            elif self.final_atom_in_trap[k] == 0 and self.final_trap_on[k] == 1:
-                # find the first non-zero element in init_atom_in_trap
-                j = k + 1
-                while j < self.ntrap-1:
-                    if self.final_atom_in_trap[j] == 1:
-                        self.final_atom_in_trap[k], self.final_atom_in_trap[j] = 1, 0  # swap
-                        self.final_freq_config_1[k] = self.init_freq_config[j]
-                        self.transition_list.append([self.final_freq_config_1[k], self.final_freq_config_2[k]])
-                        break
-                    j += 1
-            elif self.final_atom_in_trap[k] == 1 and self.final_trap_on[k] == 0:
-                self.final_atom_in_trap[k] = 0
-
-            k += 1
-
-
-test = MovingAlgo_1()
-test.calculation()
-print(test.init_atom_in_trap)
-print(test.final_atom_in_trap)
-print(test.transition_list)
\ No newline at end of file
+if __name__ == '__main__':
+    test = MovingAlgo_1()
+    test.calculation()
+    print(test.init_atom_in_trap)
+    print(test.final_atom_in_trap)
+    print(test.transition_list)
+    for mode in ('greedy', 'min_total', 'min_max'):
+        benchmark(mode=mode)
@@ -27,12 +27,23 @@
 
 # Current problem
 # 1. change mode when integrating all the functions
-# 2. only 1D currently
 
 from pyspcm import *
 from spcm_tools import *
+import numpy as np
 import sys
-import msvcrt
+import time as systime
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+try:
+    import msvcrt  # Windows only, only needed for the ESC handling below
+except ImportError:
+    msvcrt = None
+
+FIFO_NOTIFY_SIZE = 1024 * 1024  # bytes per FIFO block, the driver hands the buffer back in units of this size
+FIFO_BUFFER_SIZE = 64 * FIFO_NOTIFY_SIZE  # bytes of the software ring buffer used in FIFO mode
 
 class AWG:
     def __init__(self, time, R=625, channelNum=2, refClock=False, refClockFreq=10**7, clockOut=False):
@@ -91,20 +102,19 @@ class AWG:
         # else:
         spcm_dwSetParam_i32(self.hCard, SPC_CLOCKOUT, 0)
 
-        # compute the size of the required memory
-        # may need change!!!
-        total_sample_L = R * time
-        mem_size = 32 * (1 + (total_sample_L // 32))  # the smallest unit of buffer sample points is 32
-
         # setup the mode
-        self.llMemSamples = int64(mem_size)  ## buffer length in number of Data points
+        self.R = R
+        self.running = False
+        self.executor = None  # worker thread for execute_async, created on first use
+        self.pending = None  # future of the DMA started by execute_async
+        self.segments = None  # name -> segment index while the card is in sequence mode (setup_sequence)
         self.llLoops = int64(0)  # number of loops, 0 means continuously (replay mode)
         spcm_dwSetParam_i32(self.hCard, SPC_CARDMODE, SPC_REP_STD_SINGLE)
-        spcm_dwSetParam_i64(self.hCard, SPC_CHENABLE, CHANNEL0 | CHANNEL1)  # change here to output on two channels
-        spcm_dwSetParam_i64(self.hCard, SPC_MEMSIZE, self.llMemSamples) # buffer length in number of Data points
+        # channel 0 drives the x axis of the 2D-AOD, channel 1 the y axis
+        spcm_dwSetParam_i64(self.hCard, SPC_CHENABLE, CHANNEL0 | CHANNEL1 if channelNum == 2 else CHANNEL0)
         spcm_dwSetParam_i64(self.hCard, SPC_LOOPS, self.llLoops) # loop
         spcm_dwSetParam_i64(self.hCard, SPC_ENABLEOUT0, 1)  # output channel 0
-        spcm_dwSetParam_i64(self.hCard, SPC_ENABLEOUT1, 1)  # add this line to enable output of channel 1
+        spcm_dwSetParam_i64(self.hCard, SPC_ENABLEOUT1, 1 if channelNum == 2 else 0)  # output channel 1
 
         # Get the total number of channels
         self.lSetChannels = int32(0)
@@ -129,6 +139,22 @@ class AWG:
         spcm_dwSetParam_i32(self.hCard, SPC_AMP0, int32(1000))  # 1V for channel 1
         spcm_dwSetParam_i32(self.hCard, SPC_AMP1, int32(1000))  # 1V for channel 2
 
+        # card memory and software buffer
+        self.set_memory(time)
+
+        self.lMaxADCValue = int32(0)
+        spcm_dwGetParam_i32(self.hCard, SPC_MIINST_MAXADCVALUE, byref(self.lMaxADCValue))
+        self.dwFS = uint32(self.lMaxADCValue.value)
+        self.dwFShalf = uint32(self.dwFS.value // 2)
+        sys.stdout.write("lMaxADCValue: {0:d}\n".format(self.lMaxADCValue.value))
+
+    def set_memory(self, time):
+        # compute the size of the required memory
+        total_sample_L = int(round(self.R * time))
+        mem_size = 32 * (1 + (total_sample_L // 32))  # the smallest unit of buffer sample points is 32
+        self.llMemSamples = int64(mem_size)  ## buffer length in number of Data points
+        spcm_dwSetParam_i64(self.hCard, SPC_MEMSIZE, self.llMemSamples) # buffer length in number of Data points
+
         # setup software buffer lSetChannels
         self.qwBufferSize = uint64(self.llMemSamples.value * self.lBytesPerSample.value * self.lSetChannels.value)
         sys.stdout.write("The buffer size is: {:d}\n".format(self.qwBufferSize.value))
@@ -146,11 +172,8 @@ class AWG:
         sys.stdout.write("llMemSamples: {0:d}\n".format(self.llMemSamples.value))
 
         self.pnBuffer = cast(self.pvBuffer, ptr16)
-        self.lMaxADCValue = int32(0)
-        spcm_dwGetParam_i32(self.hCard, SPC_MIINST_MAXADCVALUE, byref(self.lMaxADCValue))
-        self.dwFS = uint32(self.lMaxADCValue.value)
-        self.dwFShalf = uint32(self.dwFS.value // 2)
-        sys.stdout.write("lMaxADCValue: {0:d}\n".format(self.lMaxADCValue.value))
+        # numpy view on the same memory, one row per sample and one column per channel (interleaved)
+        self.nBuffer = np.ctypeslib.as_array(self.pnBuffer, shape=(self.llMemSamples.value, self.lSetChannels.value))
 
     # def checkExtClock(self):
     #     if spcm_dwSetParam_i32(self.hCard, SPC_M2CMD,
@@ -161,23 +184,49 @@ class AWG:
     #         print("External clock locked.\n")
     #         return True
 
-    def transfer_data(self, time, func_x, func_y, R=625):
-        end_sample_length = self.llMemSamples.value
+    def dac_codes(self, func, L):
+        # signal -> int16 DAC codes for L samples; int16 arrays are used as they are,
+        # floats are scaled by dwFShalf and truncated like int(), a scalar (e.g. 0) fills the whole channel
+        if np.ndim(func) > 0 and len(func) < L:
+            raise ValueError(f'Signal has {len(func)} samples, {L} required.')
+        if isinstance(func, np.ndarray) and func.dtype == np.int16:
+            return func[:L]
+        func = np.asarray(func, dtype=np.float64)
+        func = np.broadcast_to(func if func.ndim == 0 else func[:L], (L,))
+        codes = np.clip(func * self.dwFShalf.value, -self.lMaxADCValue.value, self.lMaxADCValue.value)
+        return codes.astype(np.int16)
+
+    def interleave(self, func_x, func_y=None, L=None):
+        # (L, channels) int16 block: func_x/func_y per channel, or func_x as an (N, 2) array holding both
+        if func_y is None and np.ndim(func_x) == 2:
+            func_x, func_y = func_x[:, 0], func_x[:, 1]
+        if func_y is None:
+            func_y = 0
+        if L is None:
+            L = len(func_x)
+        funcs = (func_x, func_y)[:self.lSetChannels.value]
+        return np.stack([self.dac_codes(func, L) for func in funcs], axis=1)
 
+    def transfer_data(self, time, func_x, func_y=None, R=625):
         # func -> buffer
-        # func = [signal_1, signal_2, ...]
-        L = R * time
+        # func_x: signal of channel 0 (x), or an (N, 2) array holding both channels
+        # func_y: signal of channel 1 (y), None or 0 for a silent channel
+        # time: duration in us, None to use the whole signal
+        L = R * time if time is not None else len(func_x)
+        if L > self.llMemSamples.value:
+            raise ValueError(f'Signal has {L} samples but the card memory is set to {self.llMemSamples.value}.')
 
-        for i in range(L): # for each sample
-            self.pnBuffer[2*i] = int16 (int(self.dwFShalf.value * func_x[i]))
-            # self.pnBuffer[2*i+1] = int16 (int(self.dwFShalf.value * func_y[i]))
+        # nBuffer is a view on pvBuffer: all channels are written interleaved in one assignment
+        self.nBuffer[:L] = self.interleave(func_x, func_y, L)
 
         # pad 0 to those unused memories in the buffer (since the buffer length has to be a multiple of 32)
-        for i in range(L, end_sample_length, 1):
-            self.pnBuffer[i] = int16 (0)
+        self.nBuffer[L:] = 0
 
 
     def execute(self):
+        # a DMA in sequence mode would go to the current sequence segment, not to the standard memory
+        if self.segments is not None:
+            self.end_sequence()
         # we define the buffer for transfer and start the DMA transfer
         sys.stdout.write("Starting the DMA transfer and waiting until Data is in board memory\n")
         # set Data transfer
@@ -190,7 +239,8 @@ class AWG:
         if dwError != ERR_OK:
             spcm_dwSetParam_i32 (self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
             sys.stdout.write ("... Error: {0:d}\n".format(dwError))
-            exit (1)
+            raise RuntimeError('Card start failed, error {0:d}'.format(dwError))
+        self.running = True
 
         # press esc to end this program
         sys.stdout.write ("\n key: ESC ... stop replay and end program\n\n")
@@ -204,8 +254,340 @@ class AWG:
         #         break
         # spcm_vClose (self.hCard);
 
+    def execute_async(self, callback=None, poll=0.0005, timeout=5.0):
+        # start the DMA without waiting for it; a worker polls SPC_M2STATUS and starts the output once the data
+        # is in board memory. Returns a concurrent.futures.Future, callback(future) is called on completion.
+        if self.segments is not None:
+            self.end_sequence()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        spcm_dwDefTransfer_i64 (self.hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, int32 (0), self.pvBuffer, uint64 (0), self.qwBufferSize)
+        spcm_dwSetParam_i32 (self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA)
+        future = self.executor.submit(self.finish_dma, poll, timeout)
+        self.pending = future
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def execute_aio(self, **kwargs):
+        # asyncio awaitable version of execute_async
+        return asyncio.wrap_future(self.execute_async(**kwargs))
+
+    def finish_dma(self, poll, timeout):
+        lStatus = int32(0)
+        deadline = systime.monotonic() + timeout
+        while True:
+            spcm_dwGetParam_i32(self.hCard, SPC_M2STATUS, byref(lStatus))
+            if lStatus.value & M2STAT_DATA_ERROR:
+                raise RuntimeError('DMA transfer failed')
+            if lStatus.value & M2STAT_DATA_END:
+                break
+            if systime.monotonic() > deadline:
+                spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STOPDMA)
+                raise TimeoutError('DMA transfer did not finish in {0} s'.format(timeout))
+            systime.sleep(poll)
+
+        dwError = spcm_dwSetParam_i32 (self.hCard, SPC_M2CMD, M2CMD_CARD_START | M2CMD_CARD_ENABLETRIGGER)
+        if dwError != ERR_OK:
+            spcm_dwSetParam_i32 (self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
+            raise RuntimeError('Card start failed, error {0:d}'.format(dwError))
+        self.running = True
+
+    # The card handle, buffer and configuration are kept between waveforms:
+    # a new waveform only costs stop -> DMA -> start instead of open -> reset -> setup -> DMA -> close.
+    def load_waveform(self, func_x, func_y=None, time=None):
+        # time: duration in us, None to use the whole signal; the card memory is resized only if the length changes
+        samples = self.R * time if time is not None else len(func_x)
+        if 32 * (1 + (samples // 32)) != self.llMemSamples.value:
+            self.stop()
+            self.set_memory(samples / self.R)
+        self.swap(func_x, func_y, time)
+
+    def swap(self, func_x, func_y=None, time=None):
+        # replace the waveform being played, the output is dark only during the DMA
+        self.stop()
+        self.transfer_data(time, func_x, func_y, R=self.R)
+        self.execute()
+
+    # FIFO streaming (SPC_REP_FIFO_SINGLE): the waveform is produced while it is played, so its length is not
+    # limited by the card memory. producer is an iterable of chunks of any length, each chunk being a channel 0
+    # signal, an (x, y) tuple or an (N, 2) array (float or int16, see interleave). The chunks are packed into
+    # notify_size blocks of a ring buffer, which is kept topped up while the card plays.
+    def stream(self, producer, notify_size=FIFO_NOTIFY_SIZE, buffer_size=FIFO_BUFFER_SIZE, timeout=5000):
+        if buffer_size % notify_size != 0 or notify_size % 4096 != 0:
+            raise ValueError('notify_size must be a multiple of 4096 bytes and buffer_size a multiple of notify_size.')
+        self.stop()
+        bytes_per_row = self.lBytesPerSample.value * self.lSetChannels.value
+        block_samples = notify_size // bytes_per_row
+        ring_blocks = buffer_size // notify_size
+
+        spcm_dwSetParam_i32(self.hCard, SPC_CARDMODE, SPC_REP_FIFO_SINGLE)
+        spcm_dwSetParam_i64(self.hCard, SPC_LOOPS, 0)
+        spcm_dwSetParam_i32(self.hCard, SPC_TIMEOUT, timeout)
+        pvRing = pvAllocMemPageAligned(buffer_size)
+        ring = np.ctypeslib.as_array(cast(pvRing, ptr16), shape=(ring_blocks * block_samples, self.lSetChannels.value))
+        blocks = self.fifo_blocks(producer, block_samples)
+        # aborted: the card reported an error and the rest of the producer was not played
+        # timeouts: WAITDMA passes in which the card freed no space (e.g. waiting for a trigger), not underruns
+        stats = {'blocks': 0, 'samples': 0, 'underruns': 0, 'timeouts': 0, 'aborted': False}
+
+        # prefill the whole ring, then start the DMA and the output
+        filled = 0
+        for block in blocks:
+            ring[filled * block_samples:(filled + 1) * block_samples] = block
+            filled += 1
+            if filled == ring_blocks:
+                break
+        exhausted = filled < ring_blocks
+        stats['blocks'] += filled
+        if filled == 0:
+            self.set_single_mode()
+            return stats
+        spcm_dwDefTransfer_i64(self.hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, uint32(notify_size), pvRing, uint64(0),
+                               uint64(buffer_size))
+        spcm_dwSetParam_i64(self.hCard, SPC_DATA_AVAIL_CARD_LEN, filled * notify_size)
+        spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA | M2CMD_DATA_WAITDMA)
+        dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_START | M2CMD_CARD_ENABLETRIGGER)
+        if dwError != ERR_OK:
+            spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
+            self.set_single_mode()
+            raise RuntimeError(f'FIFO start failed, error {dwError}')
+        self.running = True
+
+        lStatus, llAvailUser, llUserPos = int32(0), int64(0), int64(0)
+        underrun = False
+        while not exhausted:
+            # wait until at least one block has been transferred to the card
+            dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_WAITDMA)
+            spcm_dwGetParam_i32(self.hCard, SPC_M2STATUS, byref(lStatus))
+            if dwError == ERR_TIMEOUT:
+                stats['timeouts'] += 1
+            # in replay mode the overrun flag (or a hard FIFO error) means the card ran out of data (underrun); the
+            # flag is sticky, so only the start of an underrun is counted
+            hard_error = dwError != ERR_OK and dwError != ERR_TIMEOUT
+            was_underrun, underrun = underrun, hard_error or bool(lStatus.value & M2STAT_DATA_OVERRUN)
+            if underrun and not was_underrun:
+                stats['underruns'] += 1
+                sys.stdout.write("FIFO underrun after {0:d} blocks (error {1:d})\n".format(stats['blocks'], dwError))
+            if hard_error:
+                # the card stopped (e.g. ERR_FIFOHWOVERRUN): the rest of the producer is not played
+                stats['aborted'] = True
+                sys.stdout.write("FIFO aborted after {0:d} blocks, rest of the producer dropped\n".format(stats['blocks']))
+                break
+            spcm_dwGetParam_i64(self.hCard, SPC_DATA_AVAIL_USER_LEN, byref(llAvailUser))
+            spcm_dwGetParam_i64(self.hCard, SPC_DATA_AVAIL_USER_POS, byref(llUserPos))
+            free, pos, filled = llAvailUser.value // notify_size, llUserPos.value // notify_size, 0
+            if free == 0:
+                continue
+            for block in blocks:
+                start = (pos + filled) % ring_blocks * block_samples
+                ring[start:start + block_samples] = block
+                filled += 1
+                if filled == free:
+                    break
+            exhausted = filled < free
+            stats['blocks'] += filled
+            if filled > 0:
+                spcm_dwSetParam_i64(self.hCard, SPC_DATA_AVAIL_CARD_LEN, filled * notify_size)
+
+        # let the card play out what is still queued, then go back to standard replay
+        self.wait_fifo_empty(buffer_size, timeout)
+        self.stop()
+        self.set_single_mode()
+        stats['samples'] = stats['blocks'] * block_samples
+        return stats
+
+    def fifo_blocks(self, producer, block_samples):
+        # repack producer chunks into (block_samples, channels) int16 blocks, the last one padded with 0
+        block = np.zeros((block_samples, self.lSetChannels.value), dtype=np.int16)
+        n = 0
+        for chunk in producer:
+            codes = self.interleave(*chunk) if isinstance(chunk, tuple) else self.interleave(chunk)
+            while len(codes) > 0:
+                k = min(block_samples - n, len(codes))
+                block[n:n + k] = codes[:k]
+                codes, n = codes[k:], n + k
+                if n == block_samples:
+                    yield block
+                    n = 0
+        if n > 0:
+            block[n:] = 0
+            yield block
+
+    def wait_fifo_empty(self, buffer_size, timeout):
+        llAvailUser, lFill = int64(0), int32(0)
+        deadline = systime.monotonic() + timeout / 1000
+        while systime.monotonic() < deadline:
+            spcm_dwGetParam_i64(self.hCard, SPC_DATA_AVAIL_USER_LEN, byref(llAvailUser))
+            spcm_dwGetParam_i32(self.hCard, SPC_FILLSIZEPROMILLE, byref(lFill))
+            if llAvailUser.value >= buffer_size and lFill.value == 0:
+                return True
+            systime.sleep(0.001)
+        return False
+
+    # Sequence replay (SPC_REP_STD_SEQUENCE): the card memory is split into max_segments segments which are
+    # uploaded once under a name (e.g. 'hold', 'move_3_5'); a step table chains them with loop counts and
+    # trigger conditions. Switching what plays is a write to step memory, not a new DMA of the waveform.
+    # end_sequence() (or any load_waveform / swap / execute) goes back to standard single replay.
+    def setup_sequence(self, max_segments=16):
+        self.stop()
+        spcm_dwSetParam_i32(self.hCard, SPC_CARDMODE, SPC_REP_STD_SEQUENCE)
+        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_MAXSEGMENTS, max_segments)
+        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_STARTSTEP, 0)
+        self.max_segments = max_segments
+        self.segments = {}  # name -> segment index
+
+    def end_sequence(self):
+        self.stop()
+        self.set_single_mode()
+
+    def check_sequence(self):
+        if self.segments is None:
+            raise RuntimeError('The card is not in sequence mode, call setup_sequence first.')
+
+    def upload_segment(self, name, func_x, func_y=None):
+        # (re)write segment `name`; the length is padded to a multiple of 32 samples with 0
+        self.check_sequence()
+        index = self.segments.get(name, len(self.segments))
+        if index >= self.max_segments:
+            raise ValueError(f'All {self.max_segments} segments are in use.')
+        codes = self.interleave(func_x, func_y)
+        samples = 32 * (1 + (len(codes) - 1) // 32)
+        qwBytes = samples * self.lBytesPerSample.value * self.lSetChannels.value
+        pvSegment = pvAllocMemPageAligned(qwBytes)
+        nSegment = np.ctypeslib.as_array(cast(pvSegment, ptr16), shape=(samples, self.lSetChannels.value))
+        nSegment[:len(codes)] = codes
+        nSegment[len(codes):] = 0
+
+        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_WRITESEGMENT, index)
+        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_SEGMENTSIZE, samples)
+        spcm_dwDefTransfer_i64(self.hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, int32(0), pvSegment, uint64(0), uint64(qwBytes))
+        spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA | M2CMD_DATA_WAITDMA)
+        self.segments[name] = index
+        return index
+
+    def set_step(self, step, segment, next_step, loops=1, on_trigger=False, end=False):
+        # one entry of the step table: play `segment` `loops` times, then go to `next_step`
+        # (on_trigger: keep looping until a trigger arrives; end: stop the sequence after this step)
+        self.check_sequence()
+        if isinstance(segment, str):
+            segment = self.segments[segment]
+        flags = SPCSEQ_ENDLOOPONTRIG if on_trigger else SPCSEQ_ENDLOOPALWAYS
+        if end:
+            flags |= SPCSEQ_END
+        upper = ((flags & ~SPCSEQ_LOOPMASK) | (loops & SPCSEQ_LOOPMASK)) & 0xFFFFFFFF
+        lower = ((next_step << 16) & 0xFFFF0000) | (segment & SPCSEQ_SEGMENTMASK)
+        spcm_dwSetParam_i64(self.hCard, SPC_SEQMODE_STEPMEM0 + step, int64((upper << 32) | lower))
+
+    def set_steps(self, steps):
+        # steps: list of (segment, next_step, loops[, on_trigger[, end]]), written from step 0
+        for step, entry in enumerate(steps):
+            self.set_step(step, *entry)
+
+    def start_sequence(self, start_step=0):
+        self.check_sequence()
+        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_STARTSTEP, start_step)
+        dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_START | M2CMD_CARD_ENABLETRIGGER)
+        if dwError != ERR_OK:
+            spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
+            raise RuntimeError(f'Sequence start failed, error {dwError}')
+        self.running = True
+
+    def set_single_mode(self):
+        spcm_dwSetParam_i32(self.hCard, SPC_CARDMODE, SPC_REP_STD_SINGLE)
+        spcm_dwSetParam_i64(self.hCard, SPC_LOOPS, self.llLoops)
+        spcm_dwSetParam_i64(self.hCard, SPC_MEMSIZE, self.llMemSamples)
+        self.segments = None
+
+    def swap_async(self, func_x, func_y=None, time=None, callback=None):
+        # swap() whose DMA completes in the background, returns the future of execute_async
+        self.stop()
+        self.transfer_data(time, func_x, func_y, R=self.R)
+        return self.execute_async(callback=callback)
+
+    def stop(self):
+        # a DMA still running from execute_async owns the buffer and the card, let it finish first
+        if self.pending is not None:
+            wait([self.pending])
+            self.pending = None
+        if self.running:
+            spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
+            self.running = False
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.stop()
+        spcm_vClose(self.hCard)
+
     def stop_AWG(self):
         spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_STOP)
+        self.running = False
         spcm_vClose(self.hCard)
         # exit
 
+
+# Worker thread owning an AWG session: commands (load, play, stop, shutdown) are queued and executed in order, each
+# post returns a Future. The worker blocks on the queue while idle, so waiting for the next command costs no CPU.
+class AWGController:
+    def __init__(self, awg):
+        self.awg = awg
+        self.commands = queue.Queue()
+        self.playing = threading.Event()  # set while the card outputs a waveform loaded through the controller
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def post(self, command, *args):
+        if not self.thread.is_alive():
+            raise RuntimeError('AWG controller has been shut down')
+        future = Future()
+        self.commands.put((command, args, future))
+        return future
+
+    def load(self, func_x, func_y=None, time=None):
+        # upload a new waveform (see AWG.load_waveform) and play it
+        return self.post('load', func_x, func_y, time)
+
+    def play(self):
+        # replay the waveform in the card memory
+        return self.post('play')
+
+    def stop(self):
+        return self.post('stop')
+
+    def shutdown(self, close=True):
+        # stop the card, finish the queued commands and end the worker; close: also release the card
+        future = self.post('shutdown', close)
+        self.thread.join()
+        return future
+
+    def run(self):
+        while True:
+            command, args, future = self.commands.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if command == 'load':
+                    self.awg.load_waveform(*args)
+                    self.playing.set()
+                elif command == 'play':
+                    self.awg.execute()
+                    self.playing.set()
+                elif command == 'stop':
+                    self.awg.stop()
+                    self.playing.clear()
+                elif command == 'shutdown':
+                    self.playing.clear()
+                    if args[0]:
+                        self.awg.close()
+                    else:
+                        self.awg.stop()
+                else:
+                    raise ValueError(f'Unknown AWG command: {command}')
+                future.set_result(None)
+            except BaseException as err:
+                # also SystemExit from the driver code, the worker must survive and the future must resolve
+                future.set_exception(err)
+            if command == 'shutdown':
+                break
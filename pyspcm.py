@@ -48,8 +48,16 @@ uptr32 = POINTER (uint32)
 uptr64 = POINTER (uint64)
 
 
+# Simulated card (spcm_sim.py) instead of the driver library, for testing and benchmarking without hardware
+if os.environ.get('SPCM_BACKEND', '').lower() == 'sim':
+    sys.stdout.write("Python Version: {0} with simulated spcm driver\n\n".format (platform.python_version()))
+
+    from spcm_sim import spcm_hOpen, spcm_vClose, spcm_dwGetErrorInfo_i32, spcm_dwGetParam_i32, spcm_dwGetParam_i64, \
+        spcm_dwSetParam_i32, spcm_dwSetParam_i64, spcm_dwSetParam_i64m, spcm_dwDefTransfer_i64, spcm_dwInvalidateBuf, \
+        spcm_dwGetContBuf_i64
+
 # Windows
-if os.name == 'nt':
+elif os.name == 'nt':
     sys.stdout.write("Python Version: {0} on Windows\n\n".format (platform.python_version()))
 
     # define card handle type
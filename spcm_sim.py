@@ -0,0 +1,261 @@
+# Title: Simulated spcm driver
+# Description:
+# 1. In-process stand-in for the functions pyspcm loads from the vendor library, used when the environment variable
+#    SPCM_BACKEND=sim is set (see pyspcm.py). Everything in complete_control_dev_class.py then runs without a card.
+# 2. The card is modelled as a register file plus on-board memory: standard replay memory, sequence segments and
+#    step memory, and a FIFO with a DMA rate, a replay rate and underrun detection.
+# 3. The handle returned by spcm_hOpen is the SimCard itself, so tests can inspect what would have been played,
+#    e.g. AWG(...).hCard.memory, .segments, .steps, .fifo_output(), .commands.
+
+import numpy as np
+import time as systime
+from ctypes import *
+
+from regs import *
+from spcerr import *
+
+SIM_DMA_RATE = 3.4e9  # bytes/s, PCIe x8 Gen2 of the M4i
+SIM_MEMORY = 4 * 1024 ** 3  # bytes of on-board memory
+SIM_CARD_TYPE = TYP_M4IEXPSERIES | 0x6622
+SIM_SERIAL = 12345
+
+cards = []  # every card opened in this process, most recent last
+
+
+def _value(v):
+    return v.value if hasattr(v, 'value') else v
+
+
+def _target(p):
+    # object behind byref(x) or pointer(x)
+    obj = getattr(p, '_obj', None)
+    return obj if obj is not None else p.contents
+
+
+def _address(p):
+    if isinstance(p, c_void_p):
+        return p.value
+    return addressof(p)
+
+
+class SimCard:
+    def __init__(self, name):
+        self.name = name
+        self.dma_rate = SIM_DMA_RATE
+        self.memory_bytes = SIM_MEMORY
+        self.commands = []  # (command, time) log of SPC_M2CMD writes
+        self.reset()
+
+    def reset(self):
+        self.regs = {SPC_PCITYP: SIM_CARD_TYPE, SPC_PCISERIALNO: SIM_SERIAL, SPC_FNCTYPE: SPCM_TYPE_AO,
+                     SPC_MIINST_MAXADCVALUE: 32767, SPC_MIINST_BYTESPERSAMPLE: 2, SPC_CARDMODE: SPC_REP_STD_SINGLE,
+                     SPC_CHENABLE: CHANNEL0, SPC_SAMPLERATE: MEGA(625), SPC_MEMSIZE: 0, SPC_LOOPS: 0, SPC_TIMEOUT: 0}
+        self.running = False
+        self.transfer = None  # (address, notify, length) from spcm_dwDefTransfer_i64
+        self.dma_active = False
+        self.dma_done_at = None
+        self.memory = np.zeros((0, 1), dtype=np.int16)  # standard replay memory, (samples, channels)
+        self.segments = {}  # sequence mode: index -> (samples, channels) int16
+        self.steps = {}  # sequence mode: step -> 64 bit step memory entry
+        self.fifo_chunks = []  # FIFO mode: every block handed to the card, in order
+        self.fifo_reset()
+
+    def fifo_reset(self):
+        self.fifo_given = 0  # bytes made available to the card (SPC_DATA_AVAIL_CARD_LEN)
+        self.fifo_moved = 0  # bytes moved from the host ring to on-board memory
+        self.fifo_onboard = 0
+        self.fifo_played = 0
+        self.fifo_underrun = False
+        self.fifo_updated = systime.monotonic()
+
+    # ---- derived quantities
+    def channels(self):
+        return bin(self.regs[SPC_CHENABLE] & 0xFFFFFFFF).count('1')
+
+    def bytes_per_row(self):
+        return self.regs[SPC_MIINST_BYTESPERSAMPLE] * self.channels()
+
+    def fifo_mode(self):
+        return self.regs[SPC_CARDMODE] == SPC_REP_FIFO_SINGLE
+
+    def fifo_update(self):
+        # advance the DMA (host ring -> board) and the replay (board -> DAC) to the current time
+        now = systime.monotonic()
+        dt, self.fifo_updated = now - self.fifo_updated, now
+        if self.dma_active:
+            move = min(self.fifo_given - self.fifo_moved, int(self.dma_rate * dt), self.memory_bytes - self.fifo_onboard)
+            self.fifo_moved += move
+            self.fifo_onboard += move
+        if self.running:
+            drain = int(self.regs[SPC_SAMPLERATE] * self.bytes_per_row() * dt)
+            if drain > self.fifo_onboard:
+                self.fifo_underrun = True
+                drain = self.fifo_onboard
+            self.fifo_onboard -= drain
+            self.fifo_played += drain
+
+    def status(self):
+        lStatus = M2STAT_CARD_READY if not self.running else M2STAT_NONE
+        if self.fifo_mode():
+            self.fifo_update()
+            if self.fifo_underrun:
+                lStatus |= M2STAT_DATA_OVERRUN
+            if self.transfer is not None and self.fifo_given - self.fifo_moved < self.transfer[2]:
+                lStatus |= M2STAT_DATA_BLOCKREADY
+        elif self.dma_done_at is not None and systime.monotonic() >= self.dma_done_at:
+            lStatus |= M2STAT_DATA_END
+        return lStatus
+
+    def fifo_output(self):
+        # everything streamed to the card in FIFO mode, (samples, channels)
+        if not self.fifo_chunks:
+            return np.zeros((0, self.channels()), dtype=np.int16)
+        return np.concatenate(self.fifo_chunks)
+
+    # ---- register access
+    def get(self, reg):
+        if reg == SPC_CHCOUNT:
+            return self.channels()
+        if reg == SPC_M2STATUS:
+            return self.status()
+        if reg == SPC_PCIMEMSIZE:
+            return self.memory_bytes
+        if reg in (SPC_DATA_AVAIL_USER_LEN, SPC_DATA_AVAIL_USER_POS, SPC_FILLSIZEPROMILLE):
+            self.fifo_update()
+            length = self.transfer[2] if self.transfer is not None else 0
+            if reg == SPC_DATA_AVAIL_USER_LEN:
+                return length - (self.fifo_given - self.fifo_moved)
+            if reg == SPC_DATA_AVAIL_USER_POS:
+                return self.fifo_given % length if length else 0  # start of the user-writable region
+            return int(1000 * self.fifo_onboard / self.memory_bytes)
+        return self.regs.get(reg, 0)
+
+    def set(self, reg, value):
+        if reg == SPC_M2CMD:
+            return self.command(value)
+        if reg == SPC_DATA_AVAIL_CARD_LEN:
+            return self.fifo_give(value)
+        if SPC_SEQMODE_STEPMEM0 <= reg <= SPC_SEQMODE_STEPMEM8191:
+            self.steps[reg - SPC_SEQMODE_STEPMEM0] = value & 0xFFFFFFFFFFFFFFFF
+        self.regs[reg] = value
+        return ERR_OK
+
+    def command(self, cmd):
+        self.commands.append((cmd, systime.monotonic()))
+        dwError = ERR_OK
+        if cmd & M2CMD_CARD_RESET:
+            self.reset()
+        if cmd & M2CMD_CARD_STOP:
+            self.running = False
+        if cmd & M2CMD_DATA_STOPDMA:
+            self.dma_active = False
+        if cmd & M2CMD_DATA_STARTDMA:
+            dwError = self.start_dma()
+        if cmd & M2CMD_DATA_WAITDMA:
+            dwError = self.wait_dma()
+        if cmd & M2CMD_CARD_START:
+            if not self.fifo_mode() and self.regs[SPC_MEMSIZE] * self.bytes_per_row() > self.memory_bytes:
+                return ERR_SETUP
+            if self.fifo_mode():
+                self.fifo_update()
+            self.running = True
+        return dwError
+
+    def start_dma(self):
+        if self.transfer is None:
+            return ERR_SETUP
+        address, notify, length = self.transfer
+        if self.fifo_mode():
+            self.fifo_update()
+            self.dma_active = True
+            return ERR_OK
+        self.dma_active = True
+        data = np.ctypeslib.as_array((c_int16 * (length // 2)).from_address(address)).copy()
+        data = data.reshape(-1, self.channels())
+        if self.regs[SPC_CARDMODE] == SPC_REP_STD_SEQUENCE:
+            self.segments[self.regs.get(SPC_SEQMODE_WRITESEGMENT, 0)] = data[:self.regs.get(SPC_SEQMODE_SEGMENTSIZE, len(data))]
+        else:
+            self.memory = data[:self.regs[SPC_MEMSIZE]]
+        self.dma_done_at = systime.monotonic() + length / self.dma_rate
+        return ERR_OK
+
+    def wait_dma(self):
+        timeout = self.regs[SPC_TIMEOUT] / 1000 if self.regs[SPC_TIMEOUT] else None
+        deadline = systime.monotonic() + timeout if timeout else None
+        if self.fifo_mode():
+            # until at least one notify block is free for the user again
+            while self.get(SPC_DATA_AVAIL_USER_LEN) < max(self.transfer[1], 1):
+                if deadline is not None and systime.monotonic() > deadline:
+                    return ERR_TIMEOUT
+                systime.sleep(0.0002)
+            return ERR_FIFOHWOVERRUN if self.fifo_underrun and self.running else ERR_OK
+        if self.dma_done_at is not None:
+            systime.sleep(max(0.0, self.dma_done_at - systime.monotonic()))
+        return ERR_OK
+
+    def fifo_give(self, length):
+        # the user hands `length` bytes starting at the current card position to the driver
+        self.fifo_update()
+        address, notify, ring = self.transfer
+        buffer = np.ctypeslib.as_array((c_int16 * (ring // 2)).from_address(address))
+        start = self.fifo_given % ring // 2
+        data = buffer[(start + np.arange(length // 2)) % (ring // 2)]  # wraps at the end of the ring
+        self.fifo_chunks.append(data.reshape(-1, self.channels()))
+        self.fifo_given += length
+        return ERR_OK
+
+
+# ---- the spcm_* API as loaded by pyspcm
+def spcm_hOpen(szDeviceName):
+    card = SimCard(_value(szDeviceName))
+    cards.append(card)
+    return card
+
+
+def spcm_vClose(hDevice):
+    hDevice.running = False
+
+
+def spcm_dwGetErrorInfo_i32(hDevice, pdwErrorReg, plErrorValue, szErrorText):
+    return ERR_OK
+
+
+def spcm_dwGetParam_i32(hDevice, lRegister, plValue):
+    _target(plValue).value = hDevice.get(_value(lRegister))
+    return ERR_OK
+
+
+def spcm_dwGetParam_i64(hDevice, lRegister, pllValue):
+    _target(pllValue).value = hDevice.get(_value(lRegister))
+    return ERR_OK
+
+
+def spcm_dwSetParam_i32(hDevice, lRegister, lValue):
+    return hDevice.set(_value(lRegister), _value(lValue))
+
+
+def spcm_dwSetParam_i64(hDevice, lRegister, llValue):
+    return hDevice.set(_value(lRegister), _value(llValue))
+
+
+def spcm_dwSetParam_i64m(hDevice, lRegister, lValueHigh, lValueLow):
+    return hDevice.set(_value(lRegister), (_value(lValueHigh) << 32) | (_value(lValueLow) & 0xFFFFFFFF))
+
+
+def spcm_dwDefTransfer_i64(hDevice, dwBufType, dwDirection, dwNotifySize, pvDataBuffer, qwBrdOffs, qwTransferLen):
+    hDevice.transfer = (_address(pvDataBuffer), _value(dwNotifySize), _value(qwTransferLen))
+    hDevice.dma_active, hDevice.dma_done_at = False, None
+    hDevice.fifo_chunks = []
+    hDevice.fifo_reset()
+    return ERR_OK
+
+
+def spcm_dwInvalidateBuf(hDevice, dwBufType):
+    hDevice.transfer = None
+    return ERR_OK
+
+
+def spcm_dwGetContBuf_i64(hDevice, dwBufType, ppvDataBuffer, pqwContBufLen):
+    # no continuous driver memory, the caller falls back to its own page-aligned buffer
+    _target(pqwContBufLen).value = 0
+    return ERR_OK
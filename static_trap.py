@@ -6,12 +6,44 @@
 # !!! Time needs to be adjusted !!!
 
 import numpy as np
-import datetime
-import json
+from waveform_store import new_filename, save_signal
 
 # some parameters
 R = 625  # sampling rate, unit: MHz
 #LATTICE_SPACING  unit: MHz, denotes the frequency spacing between neighboring coordinate points (min: 0.45 MHz in Lukin's paper)
+CHUNK_SIZE = 1024  # number of samples synthesised per tile, bounds the (samples x tones) work array
+MAX_ADC_VALUE = 32767  # SPC_MIINST_MAXADCVALUE of the M4i.6622-x8, use AWG.lMaxADCValue.value when the card is open
+
+
+def synthesize(time, freq, amp, phase, dtype=np.float64, chunk_size=CHUNK_SIZE):
+    # Sum of amp * sin(2 pi f t + phase) over all tones for a uniformly sampled time axis.
+    # exp(i w (t0 + tau)) = exp(i w tau) * exp(i w t0): the (tau x tones) phasor tile is evaluated once,
+    # after which every chunk of samples is a single complex matrix-vector product, so peak memory
+    # is chunk_size * ntrap regardless of the signal length and no sine is evaluated per sample.
+    time = np.asarray(time, dtype=np.float64)
+    omega = 2 * np.pi * np.asarray(freq, dtype=np.float64)
+    weight = np.asarray(amp, dtype=np.float64) * np.exp(1j * np.asarray(phase, dtype=np.float64))
+    ctype = np.result_type(dtype, np.complex64)
+
+    signal = np.zeros(len(time), dtype=dtype)
+    if len(omega) == 0 or len(time) == 0:
+        return signal
+    chunk_size = min(chunk_size, len(time))
+    dt = (time[-1] - time[0]) / (len(time) - 1) if len(time) > 1 else 0.0
+    tile = np.exp(1j * np.multiply.outer(np.arange(chunk_size) * dt, omega)).astype(ctype)
+    for start in range(0, len(time), chunk_size):
+        stop = min(start + chunk_size, len(time))
+        coeff = (weight * np.exp(1j * omega * time[start])).astype(ctype)
+        signal[start:stop] = (tile[:stop - start] @ coeff).imag
+    return signal
+
+
+def to_dac(signal, max_adc_value=MAX_ADC_VALUE):
+    # float signal -> int16 DAC codes, same scaling as AWG.transfer_data (dwFShalf = max_adc_value // 2)
+    # int16 conversion truncates toward zero like int(); clip so that overdriven samples saturate instead of wrapping
+    codes = np.multiply(signal, max_adc_value // 2, dtype=np.float64)
+    np.clip(codes, -max_adc_value, max_adc_value, out=codes)
+    return codes.astype(np.int16)
 
 
 class StaticTrap:
@@ -35,6 +67,8 @@ class StaticTrap:
 
         # output
         self.signal = np.zeros(len(self.time))
+        self.synth_amp = None  # amplitudes self.signal was synthesised with, enables update_amp()
+        self.basis = None  # optional per-tone unit sinusoids, see build_basis()
 
         # intermodulation
         self.E_2_signal = np.zeros(len(self.time))
@@ -53,13 +87,50 @@ class StaticTrap:
             print("Error: mode must be one of these: 'zero', 'random', or 'formula'.")
         return np.around(phase, decimals=5)
 
-    def get_signal(self):
-        for i in range(self.ntrap):
-            self.signal += self.amp[i] * np.sin(2 * np.pi * self.freq[i] * self.time + self.phase[i])
-
-        self.filename = './Data/static_trap_signal_' + str(datetime.datetime.now().strftime("%Y%m%d_%H%M%S")) + '.json'
-        with open(self.filename, 'w') as f:
-            json.dump(self.signal.tolist(), f)
+    def get_signal(self, dtype=np.float64, chunk_size=CHUNK_SIZE, save=True, max_adc_value=MAX_ADC_VALUE):
+        if self.can_update_amp(dtype):
+            # only the amplitudes changed since the last synthesis (IntOpt feedback loop)
+            self.update_amp(self.amp, chunk_size=chunk_size)
+        else:
+            # all tones in one batched pass, see synthesize()
+            self.signal = synthesize(self.time, self.freq, self.amp, self.phase, dtype=dtype, chunk_size=chunk_size)
+            self.synth_amp = np.array(self.amp, dtype=np.float64)
+            self.synth_freq, self.synth_phase = np.copy(self.freq), np.copy(self.phase)
+            if self.basis is not None:
+                self.build_basis(self.basis.dtype)  # freq or phase changed, the old basis is stale
+
+        # int16 codes + parameter sidecar, read back with waveform_store.load_signal
+        if save:
+            self.filename = save_signal(new_filename(), self.get_dac_signal(max_adc_value), self.get_params(max_adc_value))
+
+    def can_update_amp(self, dtype=np.float64):
+        return (self.synth_amp is not None and self.signal.dtype == dtype and len(self.amp) == len(self.synth_amp)
+                and np.array_equal(self.freq, self.synth_freq) and np.array_equal(self.phase, self.synth_phase))
+
+    def update_amp(self, amp, chunk_size=CHUNK_SIZE):
+        # signal += sum over changed tones of (amp - old amp) * sin(2 pi f t + phase), O(changed tones x samples)
+        amp = np.array(amp, dtype=np.float64)
+        delta = amp - self.synth_amp
+        changed = np.nonzero(delta)[0]
+        if len(changed) > 0:
+            if self.basis is not None:
+                self.signal += (delta[changed] @ self.basis[changed]).astype(self.signal.dtype, copy=False)
+            else:
+                self.signal += synthesize(self.time, self.freq[changed], delta[changed], self.phase[changed],
+                                          dtype=self.signal.dtype, chunk_size=chunk_size)
+        self.amp, self.synth_amp = amp, np.copy(amp)
+
+    def build_basis(self, dtype=np.float32):
+        # (ntrap, signal_length) array of unit tones: update_amp becomes a plain weighted row sum
+        self.basis = np.sin(np.multiply.outer(2 * np.pi * self.freq, self.time) + self.phase[:, None]).astype(dtype)
+
+    def get_dac_signal(self, max_adc_value=MAX_ADC_VALUE):
+        # ready-to-DMA int16 array, can be passed to AWG.transfer_data directly
+        return to_dac(self.signal, max_adc_value)
+
+    def get_params(self, max_adc_value=MAX_ADC_VALUE):
+        return {'ntrap': self.ntrap, 'freq': self.freq, 'amp': self.amp, 'phase': self.phase,
+                'R': R, 'duration': self.duration, 'max_adc_value': max_adc_value}
 
 
     # for test purpose
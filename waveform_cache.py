@@ -0,0 +1,71 @@
+# Title: Waveform cache
+# Description:
+# 1. Int16 waveforms are cached under a hash of everything that determines them: (R, duration, freq, amp, phase, scaling).
+# 2. Two tiers: a bounded in-memory LRU and an on-disk directory of .npy files (written through waveform_store),
+#    so a configuration that was already synthesised, in this run or an earlier one, costs one lookup.
+
+import numpy as np
+import hashlib
+import os
+from collections import OrderedDict
+
+from static_trap import R, MAX_ADC_VALUE
+from waveform_store import DATA_DIR, save_signal, load_signal
+
+
+def waveform_key(duration, freq, amp, phase, max_adc_value=MAX_ADC_VALUE, rate=R):
+    h = hashlib.sha1()
+    h.update(np.array([rate, duration, max_adc_value], dtype=np.float64).tobytes())
+    for arr in (freq, amp, phase):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(np.int64(arr.size).tobytes())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+class WaveformCache:
+    def __init__(self, maxsize=32, directory=os.path.join(DATA_DIR, 'cache')):
+        self.maxsize = maxsize  # number of waveforms kept in memory
+        self.directory = directory  # on-disk tier, None to disable
+        self.memory = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def key(self, trap, max_adc_value=MAX_ADC_VALUE):
+        return waveform_key(trap.duration, trap.freq, trap.amp, trap.phase, max_adc_value)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is not None and os.path.exists(self.path(key)):
+            codes = load_signal(self.path(key))
+            self._remember(key, codes)
+            return codes
+        return None
+
+    def put(self, key, codes, params=None):
+        self._remember(key, codes)
+        if self.directory is not None and not os.path.exists(self.path(key)):
+            save_signal(self.path(key), codes, params or {})
+
+    def get_dac_signal(self, trap, max_adc_value=MAX_ADC_VALUE):
+        # cached equivalent of trap.get_signal() + trap.get_dac_signal()
+        key = self.key(trap, max_adc_value)
+        codes = self.get(key)
+        if codes is not None:
+            self.hits += 1
+            return codes
+        self.misses += 1
+        trap.get_signal(save=False)
+        codes = trap.get_dac_signal(max_adc_value)
+        self.put(key, codes, trap.get_params(max_adc_value))
+        return codes
+
+    def _remember(self, key, codes):
+        self.memory[key] = codes
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
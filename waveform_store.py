@@ -0,0 +1,49 @@
+# Title: Binary waveform store
+# Description:
+# 1. Waveforms are saved as .npy files of int16 DAC codes (2 bytes per sample instead of ~20 for a JSON float),
+#    together with a small JSON sidecar (<name>.meta.json) holding the trap parameters.
+# 2. .npy files are memory-mapped on load, so the data goes to AWG.transfer_data without being parsed or copied.
+# 3. The JSON signal dumps of old runs (./Data/static_trap_signal_<timestamp>.json) can still be read.
+
+import numpy as np
+import datetime
+import json
+import os
+
+DATA_DIR = './Data'
+
+
+def new_filename(prefix='static_trap_signal', directory=DATA_DIR):
+    return os.path.join(directory, prefix + '_' + str(datetime.datetime.now().strftime("%Y%m%d_%H%M%S")) + '.npy')
+
+
+def meta_filename(filename):
+    return os.path.splitext(filename)[0] + '.meta.json'
+
+
+def save_signal(filename, codes, params):
+    # codes: int16 DAC codes, params: dict of trap parameters (ntrap, freq, amp, phase, R, ...)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    np.save(filename, np.asarray(codes, dtype=np.int16))
+    meta = {key: (value.tolist() if isinstance(value, np.ndarray) else value) for key, value in params.items()}
+    with open(meta_filename(filename), 'w') as f:
+        json.dump(meta, f)
+    return filename
+
+
+def load_signal(filename, mmap=True):
+    # .npy -> int16 codes (read-only memory map by default), .json -> legacy float list
+    if filename.endswith('.json'):
+        return load_json_signal(filename)
+    return np.load(filename, mmap_mode='r' if mmap else None)
+
+
+def load_params(filename):
+    with open(meta_filename(filename), 'r') as f:
+        return json.load(f)
+
+
+def load_json_signal(filename):
+    # signal written by the old StaticTrap.get_signal: a JSON list of floats in [-1, 1]
+    with open(filename, 'r') as f:
+        return np.array(json.load(f), dtype=np.float64)